@@ -7,27 +7,75 @@ main() {
         name="${assembly_prefix%.scaffold}"
     fi
 
+    # one round per element of round_min_coverage/round_novoalign_options;
+    # min_coverage/novoalign_options stand in for an array not given
+    rounds=$(( ${#round_min_coverage[@]} > ${#round_novoalign_options[@]} ? ${#round_min_coverage[@]} : ${#round_novoalign_options[@]} ))
+    rounds=$(( rounds > 0 ? rounds : 1 ))
+    if [ "${#round_min_coverage[@]}" -eq 0 ]; then
+        for i in $(seq $rounds); do round_min_coverage+=("$min_coverage"); done
+    fi
+    if [ "${#round_novoalign_options[@]}" -eq 0 ]; then
+        for i in $(seq $rounds); do round_novoalign_options+=("$novoalign_options"); done
+    fi
+    if [ "${#round_min_coverage[@]}" -ne "${#round_novoalign_options[@]}" ]; then
+        dx-jobutil-report-error "round_min_coverage and round_novoalign_options must have the same number of elements" AppError
+        exit 1
+    fi
+    if [ "$analysis" == "true" ] && [ -z "$aligner_options" ]; then
+        dx-jobutil-report-error "aligner_options must be given with analysis=true" AppError
+        exit 1
+    fi
+
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+    viral-ngs-stage-resources "$resources" & pids+=($!)
     dx download "$assembly" -o assembly.fasta & pids+=($!)
     dx download "$reads" -o reads.bam & pids+=($!)
-    mkdir gatk/
-    dx cat "$gatk_tarball" | tar jx -C gatk/
+    viral-ngs-stage-archive "$gatk_tarball" gatk/ & pids+=($!)
     for pid in "${pids[@]}"; do wait $pid || exit $?; done
 
     if [ "$novocraft_license" != "" ]; then
         dx cat "$novocraft_license" > novoalign.lic
     fi
 
-    viral-ngs novoindex /user-data/assembly.nix /user-data/assembly.fasta
+    # each round refines the previous round's assembly, with the reads and
+    # GATK staged once; each round's products upload during the next
+    current=assembly.fasta
+    prefix="$name"
+    pids=()
+    for i in $(seq 0 $(( rounds - 1 ))); do
+        round=$(( i + 1 ))
+        viral-ngs novoindex "/user-data/${current%.fasta}.nix" "/user-data/${current}"
+
+        viral-ngs assembly.py refine_assembly "/user-data/${current}" /user-data/reads.bam "/user-data/refined_${round}.fasta" \
+            --outVcf "/user-data/sites_${round}.vcf.gz" --min_coverage "${round_min_coverage[$i]}" --major_cutoff "$major_cutoff" \
+            --threads $(nproc) --GATK_PATH /user-data/gatk \
+            --novo_params "${round_novoalign_options[$i]}" --NOVOALIGN_LICENSE_PATH /user-data/novoalign.lic
+
+        upload_round "$round" "$prefix" & pids+=($!)
+        current="refined_${round}.fasta"
+        prefix="${prefix}.refined"
+    done
+
+    # optionally map the reads to the final assembly, as
+    # viral-ngs-assembly-analysis would, in this job
+    if [ "$analysis" == "true" ]; then
+        viral-ngs-analyze-assembly "$current" reads.bam "$name" "$aligner_options"
+    fi
+    for pid in "${pids[@]}"; do wait $pid || exit $?; done
 
-    viral-ngs assembly.py refine_assembly /user-data/assembly.fasta /user-data/reads.bam /user-data/refined_assembly.fasta \
-        --outVcf /user-data/sites.vcf.gz --min_coverage "$min_coverage" --major_cutoff "$major_cutoff" \
-        --threads $(nproc) --GATK_PATH /user-data/gatk \
-        --novo_params "$novoalign_options" --NOVOALIGN_LICENSE_PATH /user-data/novoalign.lic
+    for round in $(seq $rounds); do
+        dx-jobutil-add-output round_sites_vcfs --class=array:file "$(cat sites_${round}.id)"
+        dx-jobutil-add-output round_assemblies --class=array:file "$(cat refined_${round}.id)"
+    done
+    dx-jobutil-add-output assembly_sites_vcf --class=file "$(cat sites_${rounds}.id)"
+    dx-jobutil-add-output refined_assembly --class=file "$(cat refined_${rounds}.id)"
+}
 
-    dxid="$(pigz -dc sites.vcf.gz | dx upload --destination "${name}.refinement.vcf" --brief -)"
-    dx-jobutil-add-output assembly_sites_vcf --class=file "$dxid"
-    dxid="$(dx upload refined_assembly.fasta --destination "${name}.refined.fasta" --brief)"
-    dx-jobutil-add-output refined_assembly --class=file "$dxid"
+# upload_round <round> <name prefix>
+# Uploads a round's VCF and refined assembly, writing their IDs to
+# sites_<round>.id and refined_<round>.id.
+upload_round() {
+    set -e -o pipefail
+    pigz -dc "sites_${1}.vcf.gz" | dx upload --destination "${2}.refinement.vcf" --brief - > "sites_${1}.id"
+    dx upload "refined_${1}.fasta" --destination "${2}.refined.fasta" --brief > "refined_${1}.id"
 }
@@ -4,7 +4,7 @@ main() {
     set -e -x -o pipefail
 
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+    viral-ngs-stage-resources "$resources" & pids+=($!)
     dx download "$trinity_contigs" -o trinity_contigs.fasta & pids+=($!)
     dx download "$reference_genome" -o reference_genome.fasta & pids+=($!)
     dx download "$trinity_reads" -o reads.bam
@@ -5,25 +5,31 @@ main() {
 
     # stage the inputs
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+    viral-ngs-stage-resources "$resources" & pids+=($!)
     dx download "$targets" -o targets.fasta & pids+=($!)
     dx download "$reads" -o reads.bam
     for pid in "${pids[@]}"; do wait $pid || exit $?; done
 
-    # build Lastal target database to working dir with prefix targets.db
-    # taxon_filter.py lastal_build_db [input_fasta] [output_dir] [output_prefix]
-    viral-ngs taxon_filter.py lastal_build_db /user-data/targets.fasta /user-data --outputFilePrefix targets.db
+    # count the input reads and bases while filtering
+    viral-ngs-bamstats reads reads.bam > prefiltration_stats.json & stats_pid=$!
+
+    # Lastal target database in the working dir with prefix targets.db,
+    # from the cached index if it's the one for these targets
+    viral-ngs-reference-index lastal targets.fasta "$resources" "$targets_index"
     ls
     sha256sum targets.*
 
     # filter the reads
     viral-ngs taxon_filter.py filter_lastal_bam /user-data/reads.bam /user-data/targets.db /user-data/filtered_reads.bam
 
-    prefiltration_read_count=$(samtools view -c reads.bam)
-    prefiltration_base_count=$(bam_base_count reads.bam)
+    viral-ngs-bamstats reads filtered_reads.bam > filtered_stats.json
+    wait $stats_pid || exit $?
+
+    prefiltration_read_count=$(jq .read_count prefiltration_stats.json)
+    prefiltration_base_count=$(jq .base_count prefiltration_stats.json)
 
-    filtered_read_count=$(samtools view -c filtered_reads.bam)
-    filtered_base_count=$(bam_base_count filtered_reads.bam)
+    filtered_read_count=$(jq .read_count filtered_stats.json)
+    filtered_base_count=$(jq .base_count filtered_stats.json)
 
     dx-jobutil-add-output prefiltration_read_count $prefiltration_read_count
     dx-jobutil-add-output prefiltration_base_count $prefiltration_base_count
@@ -32,7 +38,3 @@ main() {
     dxid=$(dx upload --brief --destination "${reads_prefix}.filtered.bam" filtered_reads.bam)
     dx-jobutil-add-output filtered_reads --class=file "$dxid"
 }
-
-bam_base_count() {
-    samtools view $1 | cut -f10 | tr -d '\n' | wc -c
-}
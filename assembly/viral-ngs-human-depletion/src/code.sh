@@ -17,16 +17,28 @@ main() {
         fi
 
         pids=()
-        dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
-        dx download "$file" -o input.bam
+        viral-ngs-stage-resources "$resources" & pids+=($!)
+        dx download "$file" -o input.bam & pids+=($!)
+        # batch mode: further BAMs depleted in this job after the first, reusing
+        # the staged resources and databases
+        for i in "${!batch_files[@]}"; do
+            dx download "${batch_files[$i]}" -o "batch_${i}.bam" & pids+=($!)
+        done
         for pid in "${pids[@]}"; do wait $pid || exit $?; done
         # TODO: verify BAM is actually unmapped, contains properly paired reads, etc.
 
         if [ "$skip_depletion" == "true" ]; then
             dx-jobutil-add-output cleaned_reads --class=file "$file"
+            for batch_file in "${batch_files[@]}"; do
+                dx-jobutil-add-output batch_cleaned_reads --class=array:file "$batch_file"
+            done
             # will quit below after counting reads/bases
         fi
     elif [[ "$filename" == *.fastq.gz || "$filename" == *.fastq ]]; then
+        if [ "${#batch_files[@]}" -gt 0 ]; then
+            dx-jobutil-report-error "batch_files can only be used with unmapped BAM input" AppError
+            exit 1
+        fi
         if [ -z "$paired_fastq" ]; then
             dx-jobutil-report-error "Missing the second FASTQ file containing mate pairs" AppError
             exit 1
@@ -38,7 +50,7 @@ main() {
         fi
 
         pids=()
-        dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+        viral-ngs-stage-resources "$resources" & pids+=($!)
         # hack SRA FASTQ read names to make them acceptable to Picard FastqToSam
         maybe_dxzcat "$file" | sed -r 's/(@SRR[0-9]+\.[0-9]+)\.1/\1/' | pigz -c > reads.fastq.gz & pids+=($!)
         maybe_dxzcat "$paired_fastq" | sed -r 's/(@SRR[0-9]+\.[0-9]+)\.2/\1/' | pigz -c > reads2.fastq.gz
@@ -62,8 +74,9 @@ main() {
     fi
 
     # count reads and bases in the input
-    predepletion_read_count=$(samtools view -c input.bam)
-    predepletion_base_count=$(bam_base_count input.bam)
+    viral-ngs-bamstats reads input.bam > predepletion_stats.json
+    predepletion_read_count=$(jq .read_count predepletion_stats.json)
+    predepletion_base_count=$(jq .base_count predepletion_stats.json)
 
     dx-jobutil-add-output predepletion_read_count --class=int "$predepletion_read_count"
     dx-jobutil-add-output predepletion_base_count --class=int "$predepletion_base_count"
@@ -71,7 +84,12 @@ main() {
     if [ "$skip_depletion" == "true" ]; then
         dx-jobutil-add-output depleted_read_count --class=int "$predepletion_read_count"
         dx-jobutil-add-output depleted_base_count --class=int "$predepletion_base_count"
-        # cleaned_reads output was set above
+        for i in "${!batch_files[@]}"; do
+            viral-ngs-bamstats reads "batch_${i}.bam" > "batch_${i}_stats.json"
+            add_batch_counts predepletion "batch_${i}_stats.json"
+            add_batch_counts depleted "batch_${i}_stats.json"
+        done
+        # cleaned_reads and batch_cleaned_reads outputs were set above
         exit 0
     fi
 
@@ -90,7 +108,7 @@ main() {
         dbname=${dbname%.bmtagger_db.tar.gz}
         mkdir "bmtagger_db/${dbname}"
         local_bmtagger_dbs="${local_bmtagger_dbs} /user-data/bmtagger_db/${dbname}/${dbname}"
-        dx cat "$tarball" | pigz -dc | tar x -C "bmtagger_db/${dbname}" & pids+=($!)
+        viral-ngs-stage-archive "$tarball" "bmtagger_db/${dbname}" & pids+=($!)
     done
 
     mkdir blast_db
@@ -100,7 +118,7 @@ main() {
         dbname=${dbname%.blastndb.tar.gz}
         mkdir "blast_db/${dbname}"
         local_blast_dbs="${local_blast_dbs} /user-data/blast_db/${dbname}/${dbname}"
-        dx cat "$tarball" | pigz -dc | tar x -C "blast_db/${dbname}" & pids+=($!)
+        viral-ngs-stage-archive "$tarball" "blast_db/${dbname}" & pids+=($!)
     done
 
     for pid in "${pids[@]}"; do wait $pid || exit $?; done
@@ -110,46 +128,106 @@ main() {
     # find 90% memory, for java
     mem_in_mb=`head -n1 /proc/meminfo | awk '{print int($2*0.9/1024)}'`
 
-    # run deplete_human
-    viral-ngs taxon_filter.py deplete_human \
-        --JVMmemory ${mem_in_mb}m --threads `nproc` \
-        /user-data/input.bam /user-data/raw.bam /user-data/bmtagger_depleted.bam \
-        /user-data/rmdup.bam /user-data/cleaned.bam \
-        --bmtaggerDbs $local_bmtagger_dbs --blastDbs $local_blast_dbs
+    lane=""
+    if [ "$per_sample_output" == "true" ]; then
+        # folder structure for multi-lane outputs uses lane metadata recorded
+        # in BAM property at the end of demux
+        lane=$(dx describe --json "$file" | jq -r .properties.lane)
+    fi
+
+    deplete_bam input.bam "$sample_name" "$lane" work
 
-    depleted_read_count=$(samtools view -c cleaned.bam)
-    depleted_base_count=$(bam_base_count cleaned.bam)
+    depleted_read_count=$(jq .read_count work/depleted_stats.json)
+    depleted_base_count=$(jq .base_count work/depleted_stats.json)
 
     # upload outputs
     dx-jobutil-add-output depleted_read_count --class=int $depleted_read_count
     dx-jobutil-add-output depleted_base_count --class=int $depleted_base_count
 
-    cleaned_reads_out_folder="out/cleaned_reads"
-    intermediates_out_folder="out/intermediates"
-
-    if [ "$per_sample_output" == "true" ]; then
-        # folder structure for multi-lane outputs uses lane metadata recorded
-        # in BAM property at the end of demux
-        lane=$(dx describe --json "$file" | jq -r .properties.lane)
-        if [ "$lane" == "null" ]; then
-            cleaned_reads_out_folder="out/cleaned_reads/${sample_name}"
-            intermediates_out_folder="out/intermediates/${sample_name}"
-        else
-            cleaned_reads_out_folder="out/cleaned_reads/lane_$lane/${sample_name}"
-            intermediates_out_folder="out/intermediates/lane_$lane/${sample_name}"
+    # Batched samples go one after another, since deplete_human already uses
+    # every core. Their outputs land in the same folders a job of their own
+    # would have used; batch_cleaned_reads and the batch_*_count outputs list
+    # them in batch_files order.
+    for i in "${!batch_files[@]}"; do
+        batch_desc=$(dx describe --json "${batch_files[$i]}")
+        batch_sample_name=$(echo "$batch_desc" | jq -r .name)
+        batch_sample_name="${batch_sample_name%.bam}"
+        batch_sample_name="${batch_sample_name%.raw}"
+        batch_lane=""
+        if [ "$per_sample_output" == "true" ]; then
+            batch_lane=$(echo "$batch_desc" | jq -r .properties.lane)
         fi
+
+        viral-ngs-bamstats reads "batch_${i}.bam" > "batch_${i}_stats.json"
+        add_batch_counts predepletion "batch_${i}_stats.json"
+        deplete_bam "batch_${i}.bam" "$batch_sample_name" "$batch_lane" "batch_work_${i}" batch_out
+        add_batch_counts depleted "batch_work_${i}/depleted_stats.json"
+        rm "batch_${i}.bam"
+
+        # mirror the folder layout dx-upload-all-outputs would give them
+        cleaned_folder=$(sample_folder cleaned_reads "$batch_sample_name" "$batch_lane")
+        intermediates_folder=$(sample_folder intermediates "$batch_sample_name" "$batch_lane")
+        cleaned_id=$(dx upload --brief -p --destination "${cleaned_folder#cleaned_reads}/" \
+            "batch_out/${cleaned_folder}/${batch_sample_name}.cleaned.bam")
+        dx-jobutil-add-output batch_cleaned_reads --class=array:file "$cleaned_id"
+        for dxid in $(dx upload --brief -p --destination "${intermediates_folder#intermediates}/" \
+                "batch_out/${intermediates_folder}"/${batch_sample_name}.*.bam); do
+            dx-jobutil-add-output intermediates --class=array:file "$dxid"
+        done
+        rm -rf "batch_out/${cleaned_folder}" "batch_out/${intermediates_folder}" "batch_work_${i}"
+    done
+
+    dx-upload-all-outputs
+}
+
+# sample_folder <output field> <sample name> <lane>
+# Relative output folder for a sample's files under that field: the field
+# itself, or field/sample (field/lane_N/sample when the BAM has a lane
+# property) if per_sample_output is set.
+sample_folder() {
+    if [ "$per_sample_output" != "true" ]; then
+        echo "$1"
+    elif [ -z "$3" ] || [ "$3" == "null" ]; then
+        echo "$1/$2"
+    else
+        echo "$1/lane_$3/$2"
     fi
+}
 
-    mkdir -p $cleaned_reads_out_folder
-    mkdir -p $intermediates_out_folder
+# add_batch_counts <predepletion|depleted> <stats JSON>
+# Appends a batched sample's read and base counts, from viral-ngs-bamstats
+# reads, to batch_<stage>_read_count and batch_<stage>_base_count.
+add_batch_counts() {
+    dx-jobutil-add-output "batch_$1_read_count" --class=array:int "$(jq .read_count "$2")"
+    dx-jobutil-add-output "batch_$1_base_count" --class=array:int "$(jq .base_count "$2")"
+}
 
-    mv raw.bam "${intermediates_out_folder}/${sample_name}.raw.bam"
-    mv bmtagger_depleted.bam "${intermediates_out_folder}/${sample_name}.bmtagger_depleted.bam"
-    mv rmdup.bam "${intermediates_out_folder}/${sample_name}.rmdup.bam"
+# deplete_bam <input BAM> <sample name> <lane> <work dir> [output root]
+# Runs deplete_human on one BAM against the staged databases, leaving the
+# cleaned and intermediate BAMs under output root (default out) and the
+# read/base counts of the cleaned BAM in <work dir>/depleted_stats.json.
+deplete_bam() {
+    local input_bam="$1" name="$2" lane="$3" work="$4" out_root="${5:-out}"
+    mkdir -p "$work"
 
-    mv cleaned.bam "${cleaned_reads_out_folder}/${sample_name}.cleaned.bam"
+    viral-ngs taxon_filter.py deplete_human \
+        --JVMmemory ${mem_in_mb}m --threads `nproc` \
+        "/user-data/${input_bam}" "/user-data/${work}/raw.bam" "/user-data/${work}/bmtagger_depleted.bam" \
+        "/user-data/${work}/rmdup.bam" "/user-data/${work}/cleaned.bam" \
+        --bmtaggerDbs $local_bmtagger_dbs --blastDbs $local_blast_dbs
 
-    dx-upload-all-outputs
+    viral-ngs-bamstats reads "${work}/cleaned.bam" > "${work}/depleted_stats.json"
+
+    local cleaned_reads_out_folder="${out_root}/$(sample_folder cleaned_reads "$name" "$lane")"
+    local intermediates_out_folder="${out_root}/$(sample_folder intermediates "$name" "$lane")"
+    mkdir -p "$cleaned_reads_out_folder"
+    mkdir -p "$intermediates_out_folder"
+
+    mv "${work}/raw.bam" "${intermediates_out_folder}/${name}.raw.bam"
+    mv "${work}/bmtagger_depleted.bam" "${intermediates_out_folder}/${name}.bmtagger_depleted.bam"
+    mv "${work}/rmdup.bam" "${intermediates_out_folder}/${name}.rmdup.bam"
+
+    mv "${work}/cleaned.bam" "${cleaned_reads_out_folder}/${name}.cleaned.bam"
 }
 
 maybe_dxzcat() {
@@ -160,7 +238,3 @@ maybe_dxzcat() {
         dx cat "$1"
     fi
 }
-
-bam_base_count() {
-    samtools view $1 | cut -f10 | tr -d '\n' | wc -c
-}
@@ -5,7 +5,7 @@ main() {
 
     # stage the inputs
     pids=()
-    dx cat "$resources" | pigz -dc | tar x -C / & pids+=($!)
+    viral-ngs-stage-resources "$resources" & pids+=($!)
     dx download "$reads" -o reads.bam & pids+=($!)
     dx download "$contaminants" -o contaminants.fasta
     for pid in "${pids[@]}"; do wait $pid || exit $?; done
@@ -19,9 +19,10 @@ main() {
         --outReads /user-data/subsamp.bam 2> >(tee trinity.stderr.log >&2) || exit_code=$?
 
     # collect figures of merit
-    subsampled_read_count=$(samtools view -c subsamp.bam)
+    viral-ngs-bamstats reads subsamp.bam > subsampled_stats.json
+    subsampled_read_count=$(jq .read_count subsampled_stats.json)
     subsampled_read_pair_count=$(( subsampled_read_count / 2))
-    subsampled_base_count=$(samtools view subsamp.bam | cut -f10 | tr -d '\n' | wc -c)
+    subsampled_base_count=$(jq .base_count subsampled_stats.json)
 
     # Check for DenovoAssemblyError raised by assemble_trinity
     if [ "$exit_code" -ne "0" ]; then
@@ -41,7 +42,3 @@ main() {
     dxid=$(dx upload --brief --destination "${reads_prefix}.trinity.fasta" assembly.fasta)
     dx-jobutil-add-output contigs --class=file "$dxid"
 }
-
-bam_base_count() {
-    samtools view $1 | cut -f10 | tr -d '\n' | wc -c
-}
@@ -0,0 +1,350 @@
+"""
+Helpers for build_workflows.py. These take the dxpy module (or anything
+providing the same calls) as an explicit argument, so they can be exercised
+against a local stand-in without a DNAnexus session.
+"""
+from __future__ import print_function
+import hashlib
+import os
+import sys
+import threading
+import time
+from concurrent import futures
+
+# applet property recording the content hash its build was made from
+APPLET_HASH_PROPERTY = "applet_hash"
+
+def applet_hash(applet_dir):
+    """
+    SHA-256 over everything `dx build` packages for an applet: dxapp.json, the
+    Readme files and the src/ and resources/ trees. Each file contributes its relative path,
+    executable bit, size and content. Symlinks are followed, matching dx build,
+    which dereferences links pointing outside the applet directory.
+    """
+    paths = []
+    for entry in ("dxapp.json", "Readme.md", "Readme.developer.md", "src", "resources"):
+        top = os.path.join(applet_dir, entry)
+        if os.path.isfile(top):
+            paths.append(entry)
+        elif os.path.isdir(top):
+            for root, dirs, files in os.walk(top, followlinks=True):
+                for fn in files:
+                    paths.append(os.path.relpath(os.path.join(root, fn), applet_dir))
+
+    h = hashlib.sha256()
+    for rel in sorted(p.replace(os.sep, "/") for p in paths):
+        full = os.path.join(applet_dir, rel)
+        h.update(rel.encode("utf-8") + b"\0")
+        h.update(b"x" if os.access(full, os.X_OK) else b"-")
+        h.update(str(os.path.getsize(full)).encode("ascii") + b"\0")
+        with open(full, "rb") as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def find_cached_applets(api, project_id, hashes):
+    """
+    Find previously built applets anywhere in the project whose applet_hash
+    property is one of the given hashes, using a single find_data_objects
+    query. Returns a dict of hash: describe hash (the newest applet wins when
+    several share a hash).
+    """
+    wanted = set(hashes)
+    found = {}
+    for result in api.find_data_objects(classname="applet", project=project_id,
+                                        properties={APPLET_HASH_PROPERTY: True},
+                                        describe={"properties": True}):
+        desc = result["describe"]
+        h = desc.get("properties", {}).get(APPLET_HASH_PROPERTY)
+        if h in wanted and (h not in found or desc["created"] > found[h]["created"]):
+            found[h] = desc
+    return found
+
+class BuildError(Exception):
+    """Raised by run_tasks with every task failure collected."""
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, "{} task(s) failed:\n{}".format(len(failures),
+                           "\n".join("  {}: {}".format(name, error) for name, error in failures)))
+
+_log_lock = threading.Lock()
+
+def log(message):
+    """Print a whole line at once, so output from worker threads doesn't interleave."""
+    with _log_lock:
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
+
+def run_tasks(tasks, dependencies=None, max_workers=8):
+    """
+    Run independent tasks concurrently on a bounded thread pool. tasks is a
+    dict of name: callable; each callable receives a dict holding the results
+    of the tasks it depends on. dependencies maps a task name to the names it
+    must wait for. A task starts as soon as all of its dependencies succeed;
+    tasks downstream of a failure are skipped. Returns a dict of name: result,
+    or raises BuildError listing every failure once all runnable tasks finish.
+    """
+    dependencies = dict((name, set(dependencies.get(name, ()) if dependencies else ())) for name in tasks)
+    for name, deps in dependencies.items():
+        unknown = deps - set(tasks)
+        if unknown:
+            raise ValueError("task {} depends on unknown task(s) {}".format(name, ", ".join(sorted(unknown))))
+
+    results = {}
+    failures = []
+    failed = set()
+    pending = set(tasks)
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                deps = dependencies[name]
+                if deps & failed:
+                    pending.discard(name)
+                    failed.add(name)
+                    failures.append((name, "skipped, depends on failed task(s) " + ", ".join(sorted(deps & failed))))
+                elif deps <= set(results):
+                    pending.discard(name)
+                    running[executor.submit(tasks[name], dict((d, results[d]) for d in deps))] = name
+            if not running:
+                # whatever is left waits on a dependency cycle
+                for name in sorted(pending):
+                    failures.append((name, "skipped, circular dependency"))
+                break
+            done, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    failed.add(name)
+                    failures.append((name, "{}: {}".format(type(e).__name__, e)))
+                    log("{} failed: {}".format(name, e))
+    if failures:
+        raise BuildError(failures)
+    return results
+
+class AppletResolver(object):
+    """
+    Session-wide memo of applet name -> handler and describe hash. Applets are
+    registered by ID as they're built (or with their describe hash when reused
+    from the build cache); describe hashes for the rest come from a single
+    find_data_objects(..., describe=True) listing of the applets folder, which
+    is only repeated if an applet registered since the last listing is asked
+    for. hits/misses count lookups served from / not served from the memo.
+    """
+    def __init__(self, api, project_id, folder):
+        self.api = api
+        self.project_id = project_id
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        self._ids = {}
+        self._descs = {}
+        self._handlers = {}
+        self._lock = threading.RLock()
+
+    def add(self, name, applet_id, desc=None):
+        with self._lock:
+            self._ids[name] = applet_id
+            if desc is not None:
+                self._descs[name] = desc
+
+    def _list_folder(self):
+        for result in self.api.find_data_objects(classname="applet", project=self.project_id,
+                                                 folder=self.folder, recurse=False, describe=True):
+            desc = result["describe"]
+            self._ids.setdefault(desc["name"], desc["id"])
+            if self._ids[desc["name"]] == desc["id"]:
+                self._descs[desc["name"]] = desc
+
+    def describe(self, name):
+        with self._lock:
+            if name in self._descs:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._list_folder()
+                if name not in self._descs:
+                    raise KeyError("applet {} not found in {}:{}".format(name, self.project_id, self.folder))
+            return self._descs[name]
+
+    def get(self, name):
+        """Handler for the named applet."""
+        with self._lock:
+            if name in self._handlers:
+                self.hits += 1
+                return self._handlers[name]
+            if name not in self._ids:
+                self.describe(name)
+            else:
+                self.misses += 1
+            self._handlers[name] = self.api.DXApplet(self._ids[name], project=self.project_id)
+            return self._handlers[name]
+
+    def input_default(self, name, input_name):
+        """Default value of one of the named applet's inputs."""
+        return [x for x in self.describe(name)["inputSpec"] if x["name"] == input_name][0]["default"]
+
+class ReferenceIndexCache(object):
+    """
+    Session-wide memo of the cached reference indexes used by
+    viral-ngs-reference-index, keyed like the indexes themselves by the
+    SHA-256 of the FASTA, the index kind and the resources tarball (the
+    fasta_sha256, index_kind and resources properties). Indexes are found by
+    those properties anywhere in the project; on a miss, build(fasta_id, kind,
+    resources_id) is called to make one and must return a link to it, such as
+    a job-based object reference to the output of a job still building it.
+    Concurrent requests for the same index share one lookup. hits/misses
+    count indexes found / built.
+    """
+    def __init__(self, api, project_id, build):
+        self.api = api
+        self.project_id = project_id
+        self.build = build
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _sha256(self, fasta_id):
+        h = hashlib.sha256()
+        stream = self.api.open_dxfile(fasta_id)
+        try:
+            for chunk in iter(lambda: stream.read(1 << 20), b""):
+                h.update(chunk)
+        finally:
+            stream.close()
+        return h.hexdigest()
+
+    def _find_or_build(self, fasta_id, kind, resources_id):
+        properties = {"fasta_sha256": self._sha256(fasta_id), "index_kind": kind, "resources": resources_id}
+        for result in self.api.find_data_objects(classname="file", state="closed", project=self.project_id,
+                                                 properties=properties, limit=1):
+            with self._lock:
+                self.hits += 1
+            log("reusing {} index {} of {}".format(kind, result["id"], fasta_id))
+            return self.api.dxlink(result["id"])
+        with self._lock:
+            self.misses += 1
+        return self.build(fasta_id, kind, resources_id)
+
+    def get(self, fasta_id, kind, resources_id):
+        """Link to the kind index of fasta_id built with resources_id."""
+        with self._lock:
+            entry = self._entries.setdefault((fasta_id, kind, resources_id), {"lock": threading.Lock()})
+        with entry["lock"]:
+            if "link" not in entry:
+                entry["link"] = self._find_or_build(fasta_id, kind, resources_id)
+            return entry["link"]
+
+# execution states from which no further progress will be made
+EXECUTION_FAILURE_STATES = ("failed", "terminated", "partially_failed")
+
+class ExecutionFailed(Exception):
+    def __init__(self, desc):
+        self.desc = desc
+        failure = desc.get("failureMessage") or desc.get("failureReason") or ""
+        Exception.__init__(self, "{} ({}) {} {}".format(desc["id"], desc.get("name", ""), desc["state"], failure).strip())
+
+class ExecutionMonitor(object):
+    """
+    Watches a set of executions, polling all of them with one batched
+    find_executions(describe=True) query per round instead of blocking on
+    each in turn. A callback registered with watch() runs with the describe
+    hash as soon as that execution is done; the first execution to fail
+    raises ExecutionFailed right away. The poll interval doubles (up to
+    max_interval) while nothing changes and resets when something does.
+    Each round logs a status line, which also keeps CI consoles alive.
+    run(check) also calls check() after each round, which can raise to stop.
+    """
+    def __init__(self, api, project_id, created_after, min_interval=15, max_interval=300, sleep=time.sleep):
+        self.api = api
+        self.project_id = project_id
+        self.created_after = created_after
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.sleep = sleep
+        self._callbacks = {}
+        self._states = {}
+
+    def watch(self, execution_id, on_done=None):
+        self._callbacks[execution_id] = on_done
+        self._states[execution_id] = None
+
+    def poll(self):
+        """Returns describe hashes of the watched executions that still exist, by ID."""
+        descs = {}
+        for result in self.api.find_executions(project=self.project_id, created_after=self.created_after,
+                                               no_parent_analysis=True, include_subjobs=False, describe=True):
+            if result["id"] in self._callbacks:
+                descs[result["id"]] = result["describe"]
+        return descs
+
+    def run(self, check=None):
+        interval = self.min_interval
+        while self._callbacks:
+            changed = False
+            for execution_id, desc in sorted(self.poll().items()):
+                if desc["state"] != self._states[execution_id]:
+                    changed = True
+                    self._states[execution_id] = desc["state"]
+                if desc["state"] in EXECUTION_FAILURE_STATES:
+                    raise ExecutionFailed(desc)
+                if desc["state"] == "done":
+                    on_done = self._callbacks.pop(execution_id)
+                    del self._states[execution_id]
+                    if on_done is not None:
+                        on_done(desc)
+            if check is not None:
+                check()
+            if not self._callbacks:
+                break
+            counts = {}
+            for state in self._states.values():
+                counts[state or "pending"] = counts.get(state or "pending", 0) + 1
+            log("{} waiting on {} execution(s): {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), len(self._states),
+                ", ".join("{} {}".format(n, state) for state, n in sorted(counts.items()))))
+            interval = self.min_interval if changed else min(2 * interval, self.max_interval)
+            self.sleep(interval)
+
+def sha256_fasta_sequence(stream, chunk_size=1 << 20):
+    """
+    SHA-256 of a FASTA file with its header lines removed, reading fixed-size
+    chunks so memory use is bounded however large the assembly is. Gives the
+    same digest as `grep -v ">" | sha256sum` for any well-formed FASTA (where
+    '>' only starts header lines), including grep's newline after a final
+    line that lacks one.
+    """
+    h = hashlib.sha256()
+    at_line_start = True
+    in_header = False
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        pos = 0
+        while pos < len(chunk):
+            if at_line_start:
+                in_header = chunk[pos:pos+1] == b">"
+            newline = chunk.find(b"\n", pos)
+            end = len(chunk) if newline < 0 else newline + 1
+            if not in_header:
+                h.update(chunk[pos:end])
+            at_line_start = newline >= 0
+            pos = end
+    if not at_line_start and not in_header:
+        h.update(b"\n")
+    return h.hexdigest()
+
+def sha256_fasta_sequences(openers, max_workers=8):
+    """
+    sha256_fasta_sequence for several files in parallel. openers is a dict of
+    name: callable returning a binary file-like object; returns name: digest.
+    """
+    def digest(opener):
+        stream = opener()
+        try:
+            return sha256_fasta_sequence(stream)
+        finally:
+            stream.close()
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = dict((name, executor.submit(digest, opener)) for name, opener in openers.items())
+        return dict((name, future.result()) for name, future in pending.items())
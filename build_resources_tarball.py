@@ -5,6 +5,8 @@ import argparse
 import subprocess
 import time
 import os
+import json
+import urllib2
 
 argparser = argparse.ArgumentParser(description="Build the viral-ngs resources tarball on DNAnexus.")
 argparser.add_argument("--gatk", help="GATK tarball (default: %(default)s)",
@@ -12,15 +14,41 @@ argparser.add_argument("--gatk", help="GATK tarball (default: %(default)s)",
 argparser.add_argument("--project", help="DNAnexus project ID", default="project-BXBXK180x0z7x5kxq11p886f")
 argparser.add_argument("--folder", help="Folder within project (default: %(default)s)", default="/resources_tarball")
 argparser.add_argument("--reuse-builder", help="Reuse the existing 'builder' applet instead of recreating it", action="store_true")
+argparser.add_argument("--force", help="Build a new tarball even if one exists for the same image digest", action="store_true")
 argparser.add_argument("version", help="Desired version of broadinstitute/viral-ngs image on Docker Hub, either :TAG or @DIGEST")
 args = argparser.parse_args()
 
+def resolve_digest(version, repository="broadinstitute/viral-ngs"):
+    """Registry digest of the image :TAG or @DIGEST on Docker Hub, or None if it can't be looked up."""
+    if version.startswith("@"):
+        return version[1:]
+    try:
+        token = json.load(urllib2.urlopen("https://auth.docker.io/token?service=registry.docker.io&scope=repository:{}:pull".format(repository)))["token"]
+        request = urllib2.Request("https://registry-1.docker.io/v2/{}/manifests/{}".format(repository, version.lstrip(":")),
+                                  headers={"Authorization": "Bearer " + token,
+                                           "Accept": "application/vnd.docker.distribution.manifest.v2+json"})
+        request.get_method = lambda: "HEAD"
+        return urllib2.urlopen(request).info().getheader("Docker-Content-Digest")
+    except (urllib2.URLError, ValueError, KeyError) as e:
+        print "could not look up the digest of {}: {}".format(version, e)
+        return None
+
 project = dxpy.DXProject(args.project)
 print "project: {} ({})".format(project.name, args.project)
 project.new_folder(args.folder, parents=True)
 print "folder: {}".format(args.folder)
 
-# TODO: memoization scheme?
+# reuse the tarball built earlier from the same image, if any
+digest = resolve_digest(args.version)
+print "image digest: {}".format(digest)
+if digest and not args.force:
+    existing = list(dxpy.find_data_objects(classname="file", state="closed", project=args.project,
+                                           name="*.resources.tar.gz", name_mode="glob",
+                                           properties={"image_digest": digest}))
+    if existing:
+        print "Reusing existing tarball for this image digest"
+        print existing[0]["id"]
+        sys.exit(0)
 
 if args.reuse_builder is not True:
     subprocess.check_call(["dx","build","-f","--destination",args.project+":"+args.folder+"/",
@@ -33,6 +61,8 @@ builder = dxpy.find_one_data_object(classname='applet', name="viral-ngs-builder"
 builder_input = {
     "viral_ngs_version": args.version
 }
+if digest:
+    builder_input["image_digest"] = digest
 job = builder.run(builder_input, project=args.project, folder=args.folder, name=("viral-ngs-builder " + args.version))
 print "Waiting for builder job: {}".format(job.get_id())
 
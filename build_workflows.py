@@ -6,7 +6,8 @@ import subprocess
 import time
 import os
 import json
-import hashlib
+import build_helpers
+from concurrent import futures
 
 argparser = argparse.ArgumentParser(description="Build the viral-ngs assembly workflow on DNAnexus.")
 argparser.add_argument("--project", help="DNAnexus project ID", default="project-BXBXK180x0z7x5kxq11p886f")
@@ -16,6 +17,12 @@ argparser.add_argument("--gatk", help="GATK tarball (default: %(default)s)",
                                  default="file-By20P600jy1JY9q634Yq5PQQ")
 argparser.add_argument("--run-tests", help="run small test assemblies", action="store_true")
 argparser.add_argument("--run-large-tests", help="run test assemblies of varying sizes", action="store_true")
+argparser.add_argument("--build-jobs", type=int, default=8,
+                       help="maximum number of applets and workflows to build concurrently (default: %(default)s)")
+argparser.add_argument("--no-applet-cache", dest="applet_cache", action="store_false",
+                       help="rebuild every applet instead of reusing existing applets built from identical sources")
+argparser.add_argument("--fused-refinement", action="store_true",
+                       help="run both refinement rounds and the analysis of the assembly workflows in one job (stage 'refine') instead of three")
 args = argparser.parse_args()
 
 # detect git revision
@@ -34,50 +41,96 @@ print "folder: {}".format(args.folder)
 # BUILDING APPLETS
 ###############################################################################
 
-def build_applets():
+def applet_build_tasks():
+    """
+    Returns a dict of applet name: build task (for build_helpers.run_tasks)
+    for the applets that need building. Applets found in the build cache are
+    registered with applet_resolver directly instead.
+    """
     applets = ["assembly/viral-ngs-human-depletion", "demux/viral-ngs-human-depletion-multiplex",
                "assembly/viral-ngs-filter", "assembly/viral-ngs-trinity", "assembly/viral-ngs-assembly-scaffolding",
                "assembly/viral-ngs-assembly-refinement", "assembly/viral-ngs-assembly-analysis",
                "demux/viral-ngs-demux-wrapper", "demux/viral-ngs-demux", "demux/viral-ngs-classification",
-               "demux/viral-ngs-bwa-count-hits", "demux/viral-ngs-count-hits-multiplex"]
+               "demux/viral-ngs-bwa-count-hits", "demux/viral-ngs-count-hits-multiplex",
+               "util/viral-ngs-index-builder"]
 
-    # Build applets for assembly workflow in [args.folder]/applets/ folder
+    # Build applets for assembly workflow in [args.folder]/applets/ folder,
+    # reusing any applet already in the project that was built from identical
+    # sources (found by the applet_hash property, in one query)
     project.new_folder(applets_folder, parents=True)
+    applet_hashes = dict((applet, build_helpers.applet_hash(os.path.join(here, applet))) for applet in applets)
+    cached_applets = {}
+    if args.applet_cache:
+        cached_applets = build_helpers.find_cached_applets(dxpy, project.get_id(), applet_hashes.values())
+
+    def build_task(applet, applet_name, folder, properties):
+        def build(_):
+            applet_dxid = json.loads(subprocess.check_output(["dx","build","--destination",args.project+":"+folder+"/",os.path.join(here,applet)]))["id"]
+            build_helpers.log("built {} {}".format(applet, applet_dxid))
+            dxpy.DXApplet(applet_dxid, project=project.get_id()).set_properties(properties)
+            if folder == applets_folder:
+                applet_resolver.add(applet_name, applet_dxid)
+            return applet_dxid
+        return build
+
+    tasks = {}
     for applet in applets:
-        # TODO: reuse an existing applet with matching git_revision
-        print "building {}...".format(applet),
-        sys.stdout.flush()
-        applet_dxid = json.loads(subprocess.check_output(["dx","build","--destination",args.project+":"+applets_folder+"/",os.path.join(here,applet)]))["id"]
-        print applet_dxid
-        applet = dxpy.DXApplet(applet_dxid, project=project.get_id())
-        applet.set_properties({"git_revision": git_revision})
+        with open(os.path.join(here, applet, "dxapp.json")) as dxapp_json:
+            applet_name = json.load(dxapp_json)["name"]
+        cached_applet = cached_applets.get(applet_hashes[applet])
+        if cached_applet is not None:
+            print "reusing {} {} ({})".format(applet, cached_applet["id"], cached_applet["folder"])
+            applet_resolver.add(applet_name, cached_applet["id"], cached_applet)
+        else:
+            tasks[applet_name] = build_task(applet, applet_name, applets_folder,
+                                            {"git_revision": git_revision,
+                                             build_helpers.APPLET_HASH_PROPERTY: applet_hashes[applet]})
 
     # Build applets that user interact with directly in [args.folder]/ main folder
     exposed_applets = ["util/viral-ngs-fasta-fetcher"]
     for applet in exposed_applets:
-        print "building {}...".format(applet),
-        sys.stdout.flush()
-        applet_dxid = json.loads(subprocess.check_output(["dx","build","--destination",args.project+":"+args.folder+"/",os.path.join(here,applet)]))["id"]
-        print applet_dxid
-        applet = dxpy.DXApplet(applet_dxid, project=project.get_id())
-        applet.set_properties({"git_revision": git_revision})
+        applet_name = os.path.basename(applet)
+        tasks[applet_name] = build_task(applet, applet_name, args.folder, {"git_revision": git_revision})
+
+    return tasks
 
-build_applets()
+# name resolution for the applets used by the workflows, which may have been
+# reused from an earlier build in another folder. Filled in as builds finish;
+# describe hashes are memoized for the whole session.
+applet_resolver = build_helpers.AppletResolver(dxpy, project.get_id(), applets_folder)
 
 # helpers for name resolution
 def find_app(app_handle):
     return dxpy.find_one_app(name=app_handle, zero_ok=False, more_ok=False, return_handler=True)
 
-def find_applet(applet_name, folder=applets_folder):
-    return dxpy.find_one_data_object(classname='applet', name=applet_name,
-                                     project=project.get_id(), folder=folder,
-                                     zero_ok=False, more_ok=False, return_handler=True)
+def find_applet(applet_name):
+    return applet_resolver.get(applet_name)
 
 def find_resource_tarball_id():
-    depletion_applet = find_applet("viral-ngs-human-depletion")
-    depletion_applet_inputSpec = depletion_applet.describe()["inputSpec"]
-    resource_tarball_id = [x for x in depletion_applet_inputSpec if x["name"] == "resources"][0]["default"]
-    return resource_tarball_id
+    return applet_resolver.input_default("viral-ngs-human-depletion", "resources")
+
+# reference indexes (see viral-ngs-reference-index), built once per FASTA,
+# index kind and resources tarball and kept outside the build folders so
+# later builds find them too. Missing ones are launched without waiting and
+# passed on as references to the builder job's output; the build waits for
+# those jobs once everything else is done.
+reference_indexes_folder = "/reference_indexes"
+reference_index_jobs = []
+
+def build_reference_index(fasta_id, kind, resources_id):
+    project.new_folder(reference_indexes_folder, parents=True)
+    job = find_applet("viral-ngs-index-builder").run({"fasta": dxpy.dxlink(fasta_id), "kind": kind,
+                                                      "resources": dxpy.dxlink(resources_id)},
+                                                     project=args.project, folder=reference_indexes_folder,
+                                                     name="viral-ngs-index-builder {} {}".format(kind, fasta_id))
+    build_helpers.log("building {} index of {}: {}".format(kind, fasta_id, job.get_id()))
+    reference_index_jobs.append(job)
+    return job.get_output_ref("index")
+
+reference_indexes = build_helpers.ReferenceIndexCache(dxpy, project.get_id(), build_reference_index)
+
+def find_reference_index(fasta_id, kind, resource_tarball_id):
+    return reference_indexes.get(fasta_id, kind, dxpy.get_dxlink_ids(resource_tarball_id)[0])
 
 ###############################################################################
 # VIRAL ASSEMBLY WORKFLOWS: taking raw reads (in paired FASTQ or unmapped BAM)
@@ -106,12 +159,59 @@ assembly_workflow_resources = {
     }
 }
 
-def build_assembly_workflows(workflow_list):
-    workflows = {}
-    for w in workflow_list:
-        workflow = build_assembly_workflow(w, assembly_workflow_resources[w])
-        workflows[w] = workflow
-    return workflows
+# min_coverage and novoalign_options of the refinement rounds, and the
+# novoalign options of the analysis mapping
+refinement_rounds = [
+    (2, "-r Random -l 30 -g 40 -x 20 -t 502"),
+    (3, "-r Random -l 40 -g 40 -x 20 -t 100")
+]
+analysis_aligner_options = "-r Random -l 40 -g 40 -x 20 -t 100 -k"
+
+def add_refinement_stages(wf, refine_input, folders):
+    """
+    Add the refinement rounds and the analysis of the assembly to wf, from
+    the inputs of the first round (those not given are workflow inputs):
+    refine1 -> refine2 -> analysis stages, the refinements in the given
+    folders, or with --fused-refinement a single 'refine' stage running all
+    rounds and the analysis in one job.
+    """
+    refinement_applet = find_applet("viral-ngs-assembly-refinement")
+    if args.fused_refinement:
+        fused_input = dict(refine_input)
+        fused_input.update({
+            "round_min_coverage": [min_coverage for min_coverage, _ in refinement_rounds],
+            "round_novoalign_options": [novoalign_options for _, novoalign_options in refinement_rounds],
+            "analysis": True,
+            "aligner_options": analysis_aligner_options
+        })
+        wf.add_stage(refinement_applet, stage_input=fused_input, name="refine", folder=folders[0])
+        return
+
+    refine1_input = dict(refine_input)
+    refine1_input.update({"min_coverage": refinement_rounds[0][0], "novoalign_options": refinement_rounds[0][1]})
+    refine1_stage_id = wf.add_stage(refinement_applet, stage_input=refine1_input, name="refine1", folder=folders[0])
+
+    refine2_input = {
+        "reads": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "reads"}),
+        "assembly": dxpy.dxlink({"stage": refine1_stage_id, "outputField": "refined_assembly"}),
+        "min_coverage": refinement_rounds[1][0],
+        "novoalign_options": refinement_rounds[1][1],
+        "resources": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "resources"}),
+        "gatk_tarball": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "gatk_tarball"}),
+        "novocraft_license": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "novocraft_license"}),
+        "major_cutoff": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "major_cutoff"})
+    }
+    refine2_stage_id = wf.add_stage(refinement_applet, stage_input=refine2_input, name="refine2", folder=folders[1])
+
+    analysis_input = {
+        "assembly": dxpy.dxlink({"stage": refine2_stage_id, "outputField": "refined_assembly"}),
+        "reads": dxpy.dxlink({"stage": refine2_stage_id, "inputField": "reads"}),
+        "aligner_options": analysis_aligner_options,
+        "resources": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "resources"}),
+        "novocraft_license": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "novocraft_license"}),
+        "gatk_tarball": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "gatk_tarball"})
+    }
+    wf.add_stage(find_applet("viral-ngs-assembly-analysis"), stage_input=analysis_input, name="analysis")
 
 def build_assembly_workflow(species, resources):
     wf = dxpy.new_dxworkflow(title='viral-ngs-assembly_{0}'.format(species),
@@ -123,17 +223,15 @@ def build_assembly_workflow(species, resources):
 
     # Locate the file ID corresponding to the viral-ngs resource tarball
     depletion_applet = find_applet("viral-ngs-human-depletion")
-    depletion_applet_inputSpec = depletion_applet.describe()["inputSpec"]
-
     resource_tarball_id = find_resource_tarball_id()
 
     # These steps are used in the full assembly workflow
     if not resources.get('abridged', False):
 
         depletion_input = {
-        "bmtagger_dbs": [x for x in depletion_applet_inputSpec if x["name"] == "bmtagger_dbs"][0]["default"],
-        "blast_dbs": [x for x in depletion_applet_inputSpec if x["name"] == "blast_dbs"][0]["default"],
-        "resources": [x for x in depletion_applet_inputSpec if x["name"] == "resources"][0]["default"]
+        "bmtagger_dbs": applet_resolver.input_default("viral-ngs-human-depletion", "bmtagger_dbs"),
+        "blast_dbs": applet_resolver.input_default("viral-ngs-human-depletion", "blast_dbs"),
+        "resources": resource_tarball_id
         }
         depletion_stage_id = wf.add_stage(depletion_applet, stage_input=depletion_input, name="deplete", folder="intermediates")
 
@@ -143,6 +241,7 @@ def build_assembly_workflow(species, resources):
         }
         if "filter-targets" in resources:
             filter_input["targets"] = dxpy.dxlink(resources["filter-targets"])
+            filter_input["targets_index"] = find_reference_index(resources["filter-targets"], "lastal", resource_tarball_id)
 
         filter_stage_id = wf.add_stage(find_applet("viral-ngs-filter"), stage_input=filter_input, name="filter", folder="intermediates")
 
@@ -166,71 +265,21 @@ def build_assembly_workflow(species, resources):
 
         scaffold_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-scaffolding"), stage_input=scaffold_input, name="scaffold", folder="intermediates")
 
-        refine1_input = {
+        refine_input = {
             "assembly": dxpy.dxlink({"stage": scaffold_stage_id, "outputField": "modified_scaffold"}),
             "reads": dxpy.dxlink({"stage": depletion_stage_id, "outputField": "cleaned_reads"}),
-            "min_coverage": 2,
-            "novoalign_options": "-r Random -l 30 -g 40 -x 20 -t 502",
             "novocraft_license": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "novocraft_license"}),
             "gatk_tarball": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "gatk_tarball"}),
             "resources": dxpy.dxlink({"stage": depletion_stage_id, "inputField": "resources"})
         }
-        refine1_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine1_input, name="refine1", folder="intermediates")
-
-        refine2_input = refine1_input
-        refine2_input["assembly"] = dxpy.dxlink({"stage": refine1_stage_id, "outputField": "refined_assembly"})
-        refine2_input["min_coverage"] = 3
-        refine2_input["novoalign_options"] = "-r Random -l 40 -g 40 -x 20 -t 100"
-        refine2_input["major_cutoff"] = dxpy.dxlink({"stage": refine1_stage_id, "inputField": "major_cutoff"})
-
-        refine2_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine2_input, name="refine2", folder="intermediates")
-
-        analysis_input = {
-            "assembly": dxpy.dxlink({"stage": refine2_stage_id, "outputField": "refined_assembly"}),
-            "reads": dxpy.dxlink({"stage": refine2_stage_id, "inputField": "reads"}),
-            "aligner_options": "-r Random -l 40 -g 40 -x 20 -t 100 -k",
-            "resources": dxpy.dxlink({"stage": depletion_stage_id, "inputField": "resources"}),
-            "novocraft_license": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "novocraft_license"}),
-            "gatk_tarball": dxpy.dxlink({"stage": scaffold_stage_id, "inputField": "gatk_tarball"})
-        }
-        analysis_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-analysis"), stage_input=analysis_input, name="analysis")
+        add_refinement_stages(wf, refine_input, ["intermediates", "intermediates"])
 
     # Build abridged workflow
     else:
-        refine1_input = {
-            "min_coverage": 2,
-            "novoalign_options": "-r Random -l 30 -g 40 -x 20 -t 502",
-            "resources": resource_tarball_id
-        }
-        refine1_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine1_input, name="refine1", folder="refinement_1")
-
-        refine2_input = {
-            "reads": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "reads"}),
-            "assembly": dxpy.dxlink({"stage": refine1_stage_id, "outputField": "refined_assembly"}),
-            "min_coverage": 3,
-            "novoalign_options": "-r Random -l 40 -g 40 -x 20 -t 100",
-            "resources": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "resources"}),
-            "gatk_tarball": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "gatk_tarball"}),
-            "novocraft_license": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "novocraft_license"}),
-            "major_cutoff": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "major_cutoff"})
-        }
-        refine2_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-refinement"), stage_input=refine2_input, name="refine2", folder="refinement_2")
-
-        analysis_input = {
-            "assembly": dxpy.dxlink({"stage": refine2_stage_id, "outputField": "refined_assembly"}),
-            "reads": dxpy.dxlink({"stage": refine2_stage_id, "inputField": "reads"}),
-            "aligner_options": "-r Random -l 40 -g 40 -x 20 -t 100 -k",
-            "resources": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "resources"}),
-            "novocraft_license": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "novocraft_license"}),
-            "gatk_tarball": dxpy.dxlink({"stage": refine1_stage_id, "inputField": "gatk_tarball"})
-        }
-        analysis_stage_id = wf.add_stage(find_applet("viral-ngs-assembly-analysis"), stage_input=analysis_input, name="analysis")
+        add_refinement_stages(wf, {"resources": resource_tarball_id}, ["refinement_1", "refinement_2"])
 
     return wf
 
-# workflows = dict of species-name: workflow_id
-assembly_workflows = build_assembly_workflows(assembly_workflow_resources.keys())
-
 ###############################################################################
 # DEMUX-ONLY WORKFLOW: upon completion of a streaming run upload, demultiplex
 # the samples to unmapped BAMs, using the demux-wrapper to launch appropriate
@@ -268,7 +317,8 @@ def build_demux_only_workflow():
         "resources": dxpy.dxlink({"stage": demux_stage_id, "inputField": "resources"}),
         "in_bams": dxpy.dxlink({"stage": demux_stage_id, "outputField": "bams"}),
         "per_sample_output": True,
-        "count_hits_applet": dxpy.dxlink(count_hits_applet.id)
+        "count_hits_applet": dxpy.dxlink(count_hits_applet.id),
+        "batch_size": 16
     }
 
     count_hits_stage_id = wf.add_stage(count_hits_multiplex_applet,
@@ -277,8 +327,6 @@ def build_demux_only_workflow():
 
     return wf
 
-demux_only_workflow = build_demux_only_workflow()
-
 ###############################################################################
 # DEMUX "PLUS" WORKFLOW: upon completion of a streaming run upload, demultiplex
 # the samples to unmapped BAMs, plus run human depletion and metagenomics
@@ -315,7 +363,8 @@ def build_demux_plus_workflow():
         "resources": dxpy.dxlink({"stage": demux_stage_id, "inputField": "resources"}),
         "in_bams": dxpy.dxlink({"stage": demux_stage_id, "outputField": "bams"}),
         "per_sample_output": True,
-        "count_hits_applet": dxpy.dxlink(count_hits_applet.id)
+        "count_hits_applet": dxpy.dxlink(count_hits_applet.id),
+        "batch_size": 16
     }
 
     count_hits_stage_id = wf.add_stage(count_hits_multiplex_applet,
@@ -327,7 +376,8 @@ def build_demux_plus_workflow():
         "bams": dxpy.dxlink({"stage": demux_stage_id, "outputField": "bams"}),
         "depletion_applet": dxpy.dxlink(find_applet("viral-ngs-human-depletion")),
         "resources": dxpy.dxlink(resource_tarball_id),
-        "per_sample_output": True
+        "per_sample_output": True,
+        "batch_size_mb": 1024
     }
     depletion_stage_id = wf.add_stage(find_applet("viral-ngs-human-depletion-multiplex"), stage_input=depletion_input, name="deplete")
 
@@ -341,7 +391,58 @@ def build_demux_plus_workflow():
 
     return wf
 
-demux_plus_workflow = build_demux_plus_workflow()
+###############################################################################
+# BUILD: applets and workflows, run concurrently on a bounded pool. Each
+# workflow starts once the applets it uses have been built.
+###############################################################################
+
+assembly_applets = ["viral-ngs-human-depletion", "viral-ngs-assembly-refinement", "viral-ngs-assembly-analysis"]
+full_assembly_applets = assembly_applets + ["viral-ngs-filter", "viral-ngs-trinity", "viral-ngs-assembly-scaffolding",
+                                            "viral-ngs-index-builder"]
+demux_only_applets = ["viral-ngs-human-depletion", "viral-ngs-demux", "viral-ngs-demux-wrapper",
+                      "viral-ngs-bwa-count-hits", "viral-ngs-count-hits-multiplex"]
+demux_plus_applets = demux_only_applets + ["viral-ngs-human-depletion-multiplex", "viral-ngs-classification"]
+
+build_tasks = applet_build_tasks()
+build_dependencies = {}
+
+def add_workflow_task(name, build, required_applets):
+    build_tasks[name] = lambda _: build()
+    build_dependencies[name] = [applet for applet in required_applets if applet in build_tasks]
+
+# the reference indexes the workflows use are looked up (and any missing
+# ones launched) up front, one task each, before the workflows that need them
+for species, resources in assembly_workflow_resources.items():
+    required = assembly_applets if resources.get("abridged", False) else full_assembly_applets
+    if not resources.get("abridged", False) and "filter-targets" in resources:
+        index_task = "reference-index_lastal_" + resources["filter-targets"]
+        if index_task not in build_tasks:
+            build_tasks[index_task] = lambda _, fasta_id=resources["filter-targets"]: \
+                find_reference_index(fasta_id, "lastal", find_resource_tarball_id())
+            build_dependencies[index_task] = [applet for applet in ["viral-ngs-human-depletion", "viral-ngs-index-builder"]
+                                              if applet in build_tasks]
+        required = required + [index_task]
+    add_workflow_task("viral-ngs-assembly_" + species,
+                      lambda species=species, resources=resources: build_assembly_workflow(species, resources),
+                      required)
+add_workflow_task("viral-ngs-demux-only", build_demux_only_workflow, demux_only_applets)
+add_workflow_task("viral-ngs-demux-plus", build_demux_plus_workflow, demux_plus_applets)
+
+try:
+    build_results = build_helpers.run_tasks(build_tasks, build_dependencies, max_workers=args.build_jobs)
+    # the workflows reference the output of any index builder jobs launched
+    # above, so those must succeed too
+    build_helpers.run_tasks(dict(("viral-ngs-index-builder " + job.get_id(), lambda _, job=job: job.wait_on_done())
+                                 for job in reference_index_jobs), max_workers=args.build_jobs)
+except build_helpers.BuildError as e:
+    exit(str(e))
+
+# workflows = dict of species-name: workflow
+assembly_workflows = dict((species, build_results["viral-ngs-assembly_" + species]) for species in assembly_workflow_resources)
+demux_only_workflow = build_results["viral-ngs-demux-only"]
+demux_plus_workflow = build_results["viral-ngs-demux-plus"]
+print "applet name resolution: {} cache hits, {} misses".format(applet_resolver.hits, applet_resolver.misses)
+print "reference indexes: {} reused, {} built".format(reference_indexes.hits, reference_indexes.misses)
 
 ###############################################################################
 # TESTS
@@ -400,7 +501,9 @@ if args.run_tests is True or args.run_large_tests is True:
             "expected_alignment_base_count": 485406
         }
 
-    # Launch assembly test workflows
+    # Launch assembly test workflows. The launch time (less some allowance
+    # for clock skew) bounds the monitor's queries below.
+    test_launch_time = int(time.time() - 600) * 1000
     test_assembly_analyses = []
     for test_sample in test_samples.keys():
         # create a subfolder for this sample
@@ -467,12 +570,58 @@ if args.run_tests is True or args.run_large_tests is True:
                                                       name=(git_revision+" "+run+"-Demux-plus"))
         test_demux_analyses.append((run, demux_plus_analysis))
 
-    # wait for jobs to finish while working around Travis 10m console inactivity timeout
-    print "Waiting for analyses to finish..."
-    noise = subprocess.Popen(["/bin/bash", "-c", "while true; do date; sleep 60; done"])
-    try:
-        for (test_sample,test_analysis) in test_assembly_analyses:
-            test_analysis.wait_on_done()
+    # check figures of merit for an assembly test, as soon as it's done. The
+    # final assembly is streamed and hashed without the contig name (>...)
+    # lines on a pool of threads while the other analyses are polled, so it's
+    # never held in memory, and each hash is checked as soon as it's in.
+    assembly_hash_executor = futures.ThreadPoolExecutor(max_workers=args.build_jobs)
+    test_assembly_hashes = {}
+    analysis_stage = "refine" if args.fused_refinement else "analysis"
+
+    def refined_assembly_refs(workflow, test_analysis):
+        """References to the refined assembly of each refinement round."""
+        if args.fused_refinement:
+            return [test_analysis.get_output_ref(workflow.get_stage("refine")["id"]+".round_assemblies", index=i)
+                    for i in range(len(refinement_rounds))]
+        return [test_analysis.get_output_ref(workflow.get_stage(stage)["id"]+".refined_assembly")
+                for stage in ("refine1", "refine2")]
+
+    def hash_assembly(file_id):
+        stream = dxpy.open_dxfile(file_id, project=project.get_id())
+        try:
+            return build_helpers.sha256_fasta_sequence(stream)
+        finally:
+            stream.close()
+
+    def check_assembly_hashes(wait=False):
+        """Check each assembly hash once it's computed (waiting for them all, if wait)."""
+        for test_sample, future in sorted(test_assembly_hashes.items()):
+            if wait or future.done():
+                del test_assembly_hashes[test_sample]
+                test_assembly_sha256sum = future.result()
+                expected_sha256sum = test_samples[test_sample]["expected_assembly_sha256sum"]
+                print "\t".join([test_sample, "sha256sum", expected_sha256sum, test_assembly_sha256sum])
+                assert expected_sha256sum == test_assembly_sha256sum
+
+    def check_assembly_figures_of_merit(test_sample, workflow, analysis_desc):
+        subsampled_base_count = analysis_desc["output"][workflow.get_stage("trinity")["id"]+".subsampled_base_count"]
+        expected_subsampled_base_count = test_samples[test_sample]["expected_subsampled_base_count"]
+        print "\t".join([test_sample, "subsampled_base_count", str(expected_subsampled_base_count), str(subsampled_base_count)])
+
+        test_assembly_file_id = analysis_desc["output"][workflow.get_stage(analysis_stage)["id"]+".final_assembly"]
+        test_assembly_hashes[test_sample] = assembly_hash_executor.submit(hash_assembly, test_assembly_file_id['$dnanexus_link'])
+
+        alignment_base_count = analysis_desc["output"][workflow.get_stage(analysis_stage)["id"]+".alignment_base_count"]
+        expected_alignment_base_count = test_samples[test_sample]["expected_alignment_base_count"]
+        print "\t".join([test_sample, "alignment_base_count", str(expected_alignment_base_count), str(alignment_base_count)])
+
+        # Subsampled_base_count seems to drift, comment out for now
+        # assert expected_subsampled_base_count == subsampled_base_count
+        assert expected_alignment_base_count == alignment_base_count
+
+    def on_assembly_done(test_sample, test_analysis):
+        def check(analysis_desc):
+            print "Analysis {} for {} done".format(test_analysis.get_id(), test_sample)
             workflow = assembly_workflows[test_samples[test_sample]["species"]]
 
             # for diagnostics: add on a MUSCLE alignment of the Broad's
@@ -480,9 +629,8 @@ if args.run_tests is True or args.run_large_tests is True:
             muscle_input = {
                 "fasta": [
                     test_analysis.get_output_ref(workflow.get_stage("scaffold")["id"]+".intermediate_scaffold"),
-                    test_analysis.get_output_ref(workflow.get_stage("scaffold")["id"]+".modified_scaffold"),
-                    test_analysis.get_output_ref(workflow.get_stage("refine1")["id"]+".refined_assembly"),
-                    test_analysis.get_output_ref(workflow.get_stage("refine2")["id"]+".refined_assembly"),
+                    test_analysis.get_output_ref(workflow.get_stage("scaffold")["id"]+".modified_scaffold")
+                ] + refined_assembly_refs(workflow, test_analysis) + [
                     dxpy.dxlink(test_samples[test_sample]["broad_assembly"])
                 ],
                 "output_format": "html",
@@ -491,39 +639,37 @@ if args.run_tests is True or args.run_large_tests is True:
             }
             muscle_applet.run(muscle_input, project=project.get_id(), folder=(args.folder+"/"+test_sample), name=(git_revision+" "+test_sample+" MUSCLE"), instance_type="mem1_ssd1_x4")
 
-        for (run, demux_plus_analysis) in test_demux_analyses:
+            check_assembly_figures_of_merit(test_sample, workflow, analysis_desc)
+        return check
+
+    def on_demux_done(run):
+        def check(analysis_desc):
             # Just make sure demux plus runs without failure now,
             # TODO: check figure of merit for demux plus pipeline
-            demux_plus_analysis.wait_on_done()
-
-    finally:
-        noise.kill()
-
-    # check figures of merit for assembly tests
-    for (test_sample,test_analysis) in test_assembly_analyses:
-        workflow = assembly_workflows[test_samples[test_sample]["species"]]
-        subsampled_base_count = test_analysis.describe()["output"][workflow.get_stage("trinity")["id"]+".subsampled_base_count"]
-        expected_subsampled_base_count = test_samples[test_sample]["expected_subsampled_base_count"]
-        print "\t".join([test_sample, "subsampled_base_count", str(expected_subsampled_base_count), str(subsampled_base_count)])
-
-        # Get the final assembly and remove the contig name (>...) lines
-        test_assembly_file_id = test_analysis.describe()["output"][workflow.get_stage("analysis")["id"]+".final_assembly"]
-        dx_cat_cmd = ["dx", "cat", test_assembly_file_id['$dnanexus_link']]
-        grep_cmd = ["grep", "-v", ">"]
-        ps = subprocess.Popen(dx_cat_cmd, stdout=subprocess.PIPE)
-        editted_assembly_file = subprocess.check_output(grep_cmd, stdin=ps.stdout)
-
-        test_assembly_sha256sum = hashlib.sha256(editted_assembly_file).hexdigest()
-        expected_sha256sum = test_samples[test_sample]["expected_assembly_sha256sum"]
-        print "\t".join([test_sample, "sha256sum", expected_sha256sum, test_assembly_sha256sum])
-
-        alignment_base_count = test_analysis.describe()["output"][workflow.get_stage("analysis")["id"]+".alignment_base_count"]
-        expected_alignment_base_count = test_samples[test_sample]["expected_alignment_base_count"]
-        print "\t".join([test_sample, "alignment_base_count", str(expected_alignment_base_count), str(alignment_base_count)])
-
-        assert expected_sha256sum == test_assembly_sha256sum
-        # Subsampled_base_count seems to drift, comment out for now
-        # assert expected_subsampled_base_count == subsampled_base_count
-        assert expected_alignment_base_count == alignment_base_count
+            print "Analysis {} for {} done".format(analysis_desc["id"], run)
+        return check
+
+    # Poll all test analyses together; each sample's MUSCLE job and checks
+    # start as soon as its analysis finishes (its assembly hash is checked
+    # on a later poll round, once computed), and the first failure ends the
+    # run. The monitor's status lines work around the Travis 10m console
+    # inactivity timeout.
+    print "Waiting for analyses to finish..."
+    monitor = build_helpers.ExecutionMonitor(dxpy, project.get_id(), test_launch_time)
+    for (test_sample, test_analysis) in test_assembly_analyses:
+        monitor.watch(test_analysis.get_id(), on_assembly_done(test_sample, test_analysis))
+    for (run, demux_plus_analysis) in test_demux_analyses:
+        monitor.watch(demux_plus_analysis.get_id(), on_demux_done(run))
+    failure = None
+    try:
+        monitor.run(check=check_assembly_hashes)
+    except build_helpers.ExecutionFailed as e:
+        failure = e
+
+    # the samples that finished are checked even if another one failed
+    check_assembly_hashes(wait=True)
+    assembly_hash_executor.shutdown()
+    if failure is not None:
+        exit("Test analysis failed: {}".format(failure))
 
     print "Success"
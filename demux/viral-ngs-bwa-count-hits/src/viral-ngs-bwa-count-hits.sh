@@ -2,7 +2,7 @@
 
 main() {
 
-    dx-download-all-inputs
+    dx-download-all-inputs --parallel
 
     set -e -x -o pipefail
 
@@ -11,30 +11,58 @@ main() {
     genome_file=`ls in/ref_fasta_tar/*.bwt`
     genome_file="${genome_file%.bwt}"
 
-    # Prepare output folders
-    out_dir="out/count_files"
-    mkdir -p $out_dir
-
     if [ -z "$out_fn" ]; then
         out_fn="hit_counts.txt"
     fi
 
+    # The BAMs to count: in_bam and/or a batch of them in in_bams, mapped one
+    # after another against the index unpacked above
+    bam_paths=()
+    bam_prefixes=()
+    if [ -n "$in_bam" ]; then
+        bam_paths+=("$in_bam_path")
+        bam_prefixes+=("$in_bam_prefix")
+    fi
+    bam_paths+=("${in_bams_path[@]}")
+    bam_prefixes+=("${in_bams_prefix[@]}")
+    if [ "${#bam_paths[@]}" -eq 0 ]; then
+        dx-jobutil-report-error "Provide input reads in in_bam and/or in_bams" AppError
+        exit 1
+    fi
+
+    for i in "${!bam_paths[@]}"; do
+        count_hits "${bam_paths[$i]}" "${bam_prefixes[$i]}"
+    done
+
+    dx-upload-all-outputs
+}
+
+# count_hits <BAM> <sample name>
+count_hits() {
+    local bam_path="$1" sample_name="$2"
+
     # Output file name / directory wrangling
-    sample_name="${in_bam_prefix}"
-    sample_out_fn="$out_fn"
+    local out_dir="out/count_files"
+    local sample_out_fn="$out_fn"
     if [ "$per_sample_output" == "true" ]; then
         out_dir="$out_dir/$sample_name"
-        mkdir -p "$out_dir"
     else
         sample_out_fn="$sample_name.$out_fn"
     fi
+    mkdir -p "$out_dir"
 
-    # Perform bwa mapping
-    samtools bam2fq "${in_bam_path}" | bwa mem -t `nproc` -p "$genome_file" - | samtools view -u -S - | samtools sort -m 256M -@ `nproc` - output
-
-    # Store idxstats output as desired output file
-    samtools index output.bam
-    samtools idxstats output.bam > "${out_dir}/${sample_out_fn}"
+    # Optionally, also per-reference base counts and MAPQ histograms
+    local detail_opts=()
+    if [ "$detailed_stats" == "true" ]; then
+        local detail_dir="out/detail_files"
+        if [ "$per_sample_output" == "true" ]; then
+            detail_dir="$detail_dir/$sample_name"
+        fi
+        mkdir -p "$detail_dir"
+        detail_opts=(--bases "$detail_dir/${sample_out_fn%.txt}.bases.txt" --mapq "$detail_dir/${sample_out_fn%.txt}.mapq.txt")
+    fi
 
-    dx-upload-all-outputs
+    # Perform bwa mapping, counting hits per reference straight from its
+    # output (idxstats format, without sorting or indexing a BAM)
+    samtools bam2fq "$bam_path" | bwa mem -t `nproc` -p "$genome_file" - | sam_idxstats "${detail_opts[@]}" > "${out_dir}/${sample_out_fn}"
 }
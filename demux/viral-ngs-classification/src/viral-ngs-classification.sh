@@ -11,16 +11,52 @@ set -e -x -o pipefail
 dstat -cmdn 60 &
 
 function main() {
-  dx cat "$resources" | pigz -dc | tar x -C /
-
-  # Fetch and decompress Kraken & Krona databases.
-  extract_db "$kraken_db" "$kraken_db_name" "$kraken_db_prefix"
-  extract_db "$krona_taxonomy_db" "$krona_taxonomy_db_name" "$krona_taxonomy_db_prefix"
+  viral-ngs-stage-resources "$resources"
+
+  # Fetch and decompress Kraken & Krona databases, while describing the
+  # input samples (names and lane properties) in one API call.
+  pids=()
+  extract_db "$kraken_db" "$kraken_db_prefix" & pids+=($!)
+  extract_db "$krona_taxonomy_db" "$krona_taxonomy_db_prefix" & pids+=($!)
+  jq '{objects: [.mappings[]["$dnanexus_link"] | if type == "object" then .id else . end
+                 | {id: ., describe: {properties: true}}]}' ~/job_input.json > describe_input.json
+  dx api system describeDataObjects --input describe_input.json \
+    | jq -r '.results[].describe | "\(.id)\t\(.name)\t\(.properties.lane // "null")"' > samples.tsv
+  for pid in "${pids[@]}"; do wait $pid || exit $?; done
+
+  # Kraken memory-maps its database, so once the files are in the page cache
+  # every classifier process shares the one copy instead of faulting it in
+  # piecemeal.
+  find "./$kraken_db_prefix" -type f -print0 | xargs -0 -r -n 1 -P 8 sh -c 'cat "$0" > /dev/null'
+  free -m
+
+  # Concurrency from the instance: threads_per_sample threads for each
+  # Kraken process, as many processes as the cores allow, leaving 2GB of
+  # memory for each beyond the cached database.
+  kraken_db_mb=$(du -sm "./$kraken_db_prefix" | cut -f1)
+  total_mem_mb=$(head -n1 /proc/meminfo | awk '{print int($2/1024)}')
+  kraken_jobs=$(( $(nproc) / threads_per_sample ))
+  if [ $(( (total_mem_mb - kraken_db_mb) / 2048 )) -lt $kraken_jobs ]; then
+    kraken_jobs=$(( (total_mem_mb - kraken_db_mb) / 2048 ))
+  fi
+  if [ $kraken_jobs -lt 1 ]; then
+    kraken_jobs=1
+  fi
+  krona_jobs=$(( $(nproc) / 8 ))
+  if [ $krona_jobs -lt 2 ]; then
+    krona_jobs=2
+  fi
+  echo "Classifying $(wc -l < samples.tsv) samples, $kraken_jobs at a time with $threads_per_sample threads each"
 
-  # Process input samples
-  export -f process_bam
+  # Process input samples: each one's Krona report is made as soon as its
+  # Kraken classification finishes, overlapping with the next classifications.
+  export -f classify_bam krona_report
   export SHELL=/bin/bash
-  parallel --delay 1 -P 8 -t process_bam "$kraken_db_prefix" "$krona_taxonomy_db_prefix" ::: "${mappings[@]}"
+  export threads_per_sample
+  parallel --delay 1 -P $kraken_jobs --colsep '\t' -t \
+    classify_bam "$kraken_db_prefix" {1} {2} {3} :::: samples.tsv \
+    | parallel -P $krona_jobs --colsep '\t' -t \
+    krona_report "$krona_taxonomy_db_prefix" {1} {2} {3}
 
   # upload outputs
   dx-upload-all-outputs --parallel
@@ -28,77 +64,81 @@ function main() {
 
 function extract_db() {
   db_id="$1"
-  db_name="$2"
-  db_prefix="$3"
-
-  mkdir "./$db_prefix"
-
-  # Db can be compressed by gzip or LZ4; choose decompressor based on file
-  # extension.
-  decompressor="pigz -dc"
-  if [[ "$db_name" == *.lz4 ]]; then
-    decompressor="lz4 -d"
-  fi
-
-  dx cat "$db_id" | $decompressor | tar -C "./$db_prefix" -xvf -
+  db_prefix="$2"
 
-  if [ $(find "./$db_prefix" -type f | cut -d / -f 2,3 | sort | uniq | wc -l) -eq "1" ]; then
-    # If tarball has top-level dir, then move contents of that dir up one dir.
-    mv ./${db_prefix}/$(find "./$db_prefix" -type f | cut -d / -f 3 | uniq)/* ./${db_prefix}
-    find "./$db_prefix" -type f
-  fi
+  # The tarball may be compressed with gzip, LZ4 or zstd and may wrap the
+  # database in a top-level dir; viral-ngs-stage-archive handles both.
+  viral-ngs-stage-archive --flatten "$db_id" "./$db_prefix"
 
   du -sh "./$db_prefix"
 }
 
-function process_bam() {
+# classify_bam <Kraken db prefix> <BAM file ID> <BAM name> <lane>
+# Downloads and classifies a sample, then prints the scratch folder, output
+# folder and output filename prefix (tab-separated) for krona_report; all
+# other output goes to stderr.
+function classify_bam() {
   set -e -x -o pipefail
 
   kraken_db_prefix="$1"
-  krona_taxonomy_db_prefix="$2"
-
-  # stage input BAM
-  bam_id=$(dx-jobutil-parse-link --no-project "$3")
-  bam_name=$(dx describe --name "$3")
-
-  mkdir -p "scratch/${bam_id}/krona"
-  dx download -o "scratch/${bam_id}/${bam_name}" "$bam_id"
-
-  # folder structure for multi-lane outputs uses lane metadata recorded
-  # in BAM property at the end of demux
-  lane=$(dx describe --json "$bam_id" | jq -r .properties.lane)
-  if [ "$lane" == "null" ]; then
-      output_root_dir="out/outputs/"
-  else
-      output_root_dir="out/outputs/lane_$lane/"
-  fi
+  bam_id="$2"
+  bam_name="$3"
+  lane="$4"
+
+  {
+    # stage input BAM
+    mkdir -p "scratch/${bam_id}/krona"
+    dx download -o "scratch/${bam_id}/${bam_name}" "$bam_id"
+
+    # folder structure for multi-lane outputs uses lane metadata recorded
+    # in BAM property at the end of demux
+    if [ "$lane" == "null" ]; then
+        output_root_dir="out/outputs/"
+    else
+        output_root_dir="out/outputs/lane_$lane/"
+    fi
+
+    output_filename_prefix="${bam_name%.bam}"
+    output_filename_prefix="${output_filename_prefix%.cleaned}"
+    output_root_dir="${output_root_dir}${output_filename_prefix}"
+    mkdir -p "$output_root_dir"
+
+    # Use Kraken to classify taxonomic profile of sample.
+    viral-ngs metagenomics.py kraken \
+                    "/user-data/scratch/${bam_id}/${bam_name}" \
+                    "/user-data/${kraken_db_prefix}" \
+                    --outReads "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-classified.txt.gz" \
+                    --outReport "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-report.txt" \
+                    --numThreads "$threads_per_sample"
+
+    rm "scratch/${bam_id}/${bam_name}"
+  } >&2
+
+  printf '%s\t%s\t%s\n' "scratch/${bam_id}" "$output_root_dir" "$output_filename_prefix"
+}
 
-  output_filename_prefix="${bam_name%.bam}"
-  output_filename_prefix="${output_filename_prefix%.cleaned}"
-  output_root_dir="${output_root_dir}${output_filename_prefix}"
-  mkdir -p "$output_root_dir"
+# krona_report <Krona taxonomy db prefix> <scratch folder> <output folder> <output filename prefix>
+function krona_report() {
+  set -e -x -o pipefail
 
-  # Use Kraken to classify taxonomic profile of sample.
-  viral-ngs metagenomics.py kraken \
-                  "/user-data/scratch/${bam_id}/${bam_name}" \
-                  "/user-data/${kraken_db_prefix}" \
-                  --outReads "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-classified.txt.gz" \
-                  --outReport "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-report.txt" \
-                  --numThreads 4
+  krona_taxonomy_db_prefix="$1"
+  scratch_dir="$2"
+  output_root_dir="$3"
+  output_filename_prefix="$4"
 
   # Use Krona to visualize taxonomic profiling output from Kraken.
   viral-ngs metagenomics.py krona \
                   "/user-data/${output_root_dir}/${output_filename_prefix}.kraken-classified.txt.gz" \
                   "/user-data/${krona_taxonomy_db_prefix}" \
-                  "/user-data/scratch/${bam_id}/krona/${output_filename_prefix}.krona-report.html" \
+                  "/user-data/${scratch_dir}/krona/${output_filename_prefix}.krona-report.html" \
                   --noRank
 
   # Standalone html file output
-  cp "scratch/${bam_id}/krona/${output_filename_prefix}.krona-report.html" "${output_root_dir}/"
+  cp "${scratch_dir}/krona/${output_filename_prefix}.krona-report.html" "${output_root_dir}/"
 
   # Tar all html and attached js files for easy download
-  tar cf "${output_root_dir}/${output_filename_prefix}.krona-report.tar" -C "scratch/$bam_id/krona" .
+  tar cf "${output_root_dir}/${output_filename_prefix}.krona-report.tar" -C "${scratch_dir}/krona" .
 
   # cleanup
-  rm -rf "scratch/${bam_id}"
+  rm -rf "${scratch_dir}"
 }
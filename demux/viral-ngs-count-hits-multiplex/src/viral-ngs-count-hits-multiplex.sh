@@ -36,47 +36,104 @@ main() {
 
     count_hits_applet_id=$(dx-jobutil-parse-link "$count_hits_applet")
     fastqc_applet_id=$(dx-jobutil-parse-link "$fastqc_applet")
-    fastqc_job_ids=()
 
-    #########################################
-    # Lauch viral-ngs-count-hits and fastqc #
-    #########################################
-    for i in "${!in_bams[@]}"; do
-
-        bam="${in_bams[$i]}"
-        bam_name="${in_bams_prefix[$i]}"
-        lane_folder=""
-        lane=$(dx describe --json "$bam" | jq -r .properties.lane)
-        if [ "$lane" != "null" ]; then
-            lane_folder="/lane_$lane"
-        fi
+    # lane properties of all the BAMs, in one API call
+    jq '{objects: [.in_bams[]["$dnanexus_link"] | if type == "object" then .id else . end
+                   | {id: ., describe: {properties: true}}]}' ~/job_input.json > describe_input.json
+    dx api system describeDataObjects --input describe_input.json > in_bams.json
+    mapfile -t bam_ids < <(jq -r '.results[].describe.id' in_bams.json)
+    mapfile -t lanes < <(jq -r '.results[].describe.properties.lane' in_bams.json)
 
-        count_hit_job_id=$(dx run $count_hits_applet_id \
-        -iin_bam="${bam}" \
-        -iper_sample_output="${per_sample_output}" \
-        -iref_fasta_tar="${ref_fasta}" \
-        -iout_fn="${out_fn}" \
-        --name "count_hits $bam_name" \
-        ${lane_folder:+--destination "$lane_folder"} \
-        $opts --yes --brief)
-
-        fastqc_dest="$lane_folder"
-        if [ "$per_sample_output" == "true" ]; then
-            fastqc_dest="$fastqc_dest/$bam_name"
+    # Group the BAMs into count-hits jobs of up to batch_size BAMs, which share
+    # one download of the reference index. A job's outputs go to its lane
+    # folder, so BAMs from different lanes are never grouped together.
+    batches=()
+    declare -A lane_batch
+    for i in "${!bam_ids[@]}"; do
+        b="${lane_batch[${lanes[$i]}]}"
+        if [ -z "$b" ] || [ $(wc -w <<< "${batches[$b]}") -ge "$batch_size" ]; then
+            b=${#batches[@]}
+            batches+=("")
+            lane_batch[${lanes[$i]}]=$b
         fi
+        batches[$b]="${batches[$b]} $i"
+    done
 
-        fastqc_job_id=$(dx run $fastqc_applet_id \
-        -ireads="${bam}" \
-        -iformat="${format}" -ikmer_size="${kmer_size}" \
-        -inogroup="${nogroup}" $fastqc_opts \
-        --name "fastqc $bam_name" \
-        ${fastqc_dest:+--destination "$fastqc_dest"} \
-        --yes --brief)
-
-        fastqc_job_ids+=($fastqc_job_id)
+    #########################################
+    # Lauch viral-ngs-count-hits and fastqc #
+    #########################################
+    # FastQC is a separate applet taking one file, so it still gets a job per
+    # BAM. All the jobs are submitted concurrently, max_launches at a time.
+    mkdir -p jobs
+    launches=()
+    for b in "${!batches[@]}"; do
+        launches+=("launch_count_hits $b")
+    done
+    for i in "${!bam_ids[@]}"; do
+        launches+=("launch_fastqc $i")
+    done
+    for ((start = 0; start < ${#launches[@]}; start += max_launches)); do
+        pids=()
+        for launch in "${launches[@]:start:max_launches}"; do
+            $launch & pids+=($!)
+        done
+        for pid in "${pids[@]}"; do wait $pid || exit $?; done
+    done
 
-        dx-jobutil-add-output count_files $count_hit_job_id:count_files --class=array:jobref
+    for b in "${!batches[@]}"; do
+        dx-jobutil-add-output count_files $(cat jobs/count_hits_$b):count_files --class=array:jobref
+    done
+    for i in "${!bam_ids[@]}"; do
+        fastqc_job_id=$(cat jobs/fastqc_$i)
         dx-jobutil-add-output report_html $fastqc_job_id:report_html --class=array:jobref
         dx-jobutil-add-output stats_txt $fastqc_job_id:stats_txt --class=array:jobref
     done
 }
+
+lane_folder() {
+    if [ "${lanes[$1]}" != "null" ]; then
+        echo "/lane_${lanes[$1]}"
+    fi
+}
+
+# launch_count_hits <batch index>
+launch_count_hits() {
+    local bams=(${batches[$1]})
+    local first=${bams[0]}
+    local lane_folder=$(lane_folder $first)
+    local inputs=() name="count_hits ${in_bams_prefix[$first]}"
+    if [ "${#bams[@]}" -eq 1 ]; then
+        inputs=(-iin_bam="${bam_ids[$first]}")
+    else
+        for i in "${bams[@]}"; do
+            inputs+=(-iin_bams="${bam_ids[$i]}")
+        done
+        name="$name and $(( ${#bams[@]} - 1 )) more"
+    fi
+
+    dx run $count_hits_applet_id \
+    "${inputs[@]}" \
+    -iper_sample_output="${per_sample_output}" \
+    -iref_fasta_tar="${ref_fasta}" \
+    -iout_fn="${out_fn}" \
+    --name "$name" \
+    ${lane_folder:+--destination "$lane_folder"} \
+    $opts --yes --brief > jobs/count_hits_$1
+}
+
+# launch_fastqc <BAM index>
+launch_fastqc() {
+    local bam_name="${in_bams_prefix[$1]}"
+    local fastqc_dest=$(lane_folder $1)
+    if [ "$per_sample_output" == "true" ]; then
+        fastqc_dest="$fastqc_dest/$bam_name"
+    fi
+
+    dx run $fastqc_applet_id \
+    -ireads="${bam_ids[$1]}" \
+    -iformat="${format}" -ikmer_size="${kmer_size}" \
+    -inogroup="${nogroup}" $fastqc_opts \
+    --name "fastqc $bam_name" \
+    ${fastqc_dest:+--destination "$fastqc_dest"} \
+    --yes --brief > jobs/fastqc_$1
+}
@@ -55,6 +55,25 @@ main() {
             instance_type="mem1_hdd2_x32"
             echo "Tile count: $total_tile_count tiles, (unknown instrument type), executing on a $instance_type machine."
         fi
+
+        # data volume tracks tiles times cycles; both are recorded on the
+        # demux job for fitting the sizing model (util-scripts/fit_instance_model.py)
+        total_cycles=$(xmllint --xpath "sum(//Run/Reads/Read/@NumCycles)" RunInfo.xml)
+        tile_cycles=$((total_tile_count*${total_cycles%.*}))
+        features=(total_tile_count=$total_tile_count tile_cycles=$tile_cycles)
+
+        # with a sizing model, use the cheapest instance type predicted to
+        # have enough memory and disk and to finish in time instead
+        if [ -n "$instance_model" ]; then
+            dx cat "$instance_model" > instance_model.json
+            # never smaller than the demux applet's own default
+            default_instance_type=$(dx describe "$(dx-jobutil-parse-link "$demux_applet")" --json | jq -r .runSpec.systemRequirements.main.instanceType)
+            if model_instance_type=$(viral-ngs-instance-type --model instance_model.json --at-least "$default_instance_type" \
+                    viral-ngs-demux "${features[@]}"); then
+                instance_type="$model_instance_type"
+                echo "Sizing model chose a $instance_type machine."
+            fi
+        fi
     fi
 
     if [ "$upload_sentinel_record" == "" ] && [ "$is_hiseq" == 'true' ];
@@ -135,6 +154,7 @@ main() {
     # $opts should not contain DNAnexus links)
     job_id=$(dx run $demux_applet_id \
     --instance-type="$instance_type" \
+    "${features[@]/#/--property=}" \
     -iresources="${resources}" \
     -iper_sample_output="${per_sample_output}" $opts \
     --yes --brief)
@@ -5,7 +5,7 @@ main() {
     set -e -x -o pipefail
 
     # Unpack viral-ngs resources
-    dx cat "$resources" | pigz -dc | tar x -C /
+    viral-ngs-stage-resources "$resources"
 
     # Raise error if both of upload_sentinel_record and tarballs are specified
     if [ "$upload_sentinel_record" != "" ] && [ "$run_tarballs" != "" ]; then
@@ -23,23 +23,30 @@ main() {
     if [ "$upload_sentinel_record" != "" ]; then
         # Unpack from sentinel_record
 
-        # Get file IDs of run directory tarballs
-        file_ids=$(dx get_details "$upload_sentinel_record" | jq .tar_file_ids | grep -Po '(?<=\")file-.*(?=\")')
-
-        # This array is space separated, do not quote
-        for file_id in ${file_ids[@]}; do
-            dx cat "$file_id" | pigz -dc | tar xf - -C ./input/ --owner root --group root --no-same-owner
-        done
+        # Get file IDs of run directory tarballs; the incremental upload
+        # closes the record once it has uploaded every tarball
+        dx describe "$upload_sentinel_record" --details --json > sentinel.json
+        if [ "$(jq -r .state sentinel.json)" != "closed" ]; then
+            dx-jobutil-report-error "The upload sentinel record $(jq -r .id sentinel.json) isn't closed yet, the run upload is incomplete" AppError
+            exit 1
+        fi
+        file_ids=($(jq -r '.details.tar_file_ids[]' sentinel.json))
+        if [ ${#file_ids[@]} -eq 0 ]; then
+            dx-jobutil-report-error "The upload sentinel record lists no tar_file_ids" AppError
+            exit 1
+        fi
     else
         # Unpack from run_tarballs, this array contain
-        # Elements with spaces, so we need to quote to retain
-        # the dnanexus link field intact
+        # Elements with spaces, so parse the file IDs out of
+        # the dnanexus links
+        file_ids=()
         for file_id in "${run_tarballs[@]}"; do
-            echo "$file_id"
-            dx cat "$file_id" | pigz -dc | tar xf - -C ./input/ --owner root --group root --no-same-owner
+            file_ids+=($(dx-jobutil-parse-link "$file_id"))
         done
     fi
 
+    stage_run_tarballs "${file_ids[@]}"
+
     # Locate root of run directory
     location_of_data=$(find ./input/ -type d -name "Data")
     if [ "$location_of_data" == "" ]
@@ -62,8 +69,6 @@ main() {
     fi
 
     # Populate command line options
-    # The --JVMemory arg ensures that $opts is non-empty
-    mem_in_mb="`head -n1 /proc/meminfo | awk '{print int($2*0.9/1024)}'`m"
     opts=()
 
     if [ "$sample_sheet" != "" ]
@@ -113,109 +118,224 @@ main() {
     # specified, demux over all lanes
     if [ ${#lanes[@]} -eq 0 ];
     then
-        lanes=$(seq 1 $lane_count)
+        lanes=($(seq 1 $lane_count))
     fi
 
     multi_lane=false
 
-    if [ "${#lanes}" -gt 1 ];
+    if [ "${#lanes[@]}" -gt 1 ];
     then
         multi_lane=true
     fi
 
-    # Make sure that the lane specified is valid
+    # Make sure that the lane specified is valid, and that its base calls
+    # were in the tarballs
     for lane in ${lanes[@]}
     do
         if [ $lane -gt $lane_count ];
         then
             dx-jobutil-report-error "Invalid lane: $lane, there are only $lane_count lane(s) detected in the run."
         fi
+        lane_basecalls="$location_of_input/Data/Intensities/BaseCalls/L$(printf %03d $lane)"
+        if [ ! -d "$lane_basecalls" ]; then
+            dx-jobutil-report-error "The run folder is incomplete: $lane_basecalls is missing." AppError
+            exit 1
+        fi
     done
 
-    for lane in ${lanes[@]}
-    do
-        # Prepare output folders
-        bam_out_dir="out/bams"
-        unmatched_out_dir="out/unmatched_bams"
-        metric_out_dir="out/metrics"
-        barcode_out_dir="out/barcodes"
-
-        # Subfolders by lane if multi-lane run
-        if [ "$multi_lane" = true ]; then
-            bam_out_dir="$bam_out_dir/lane_$lane"
-            unmatched_out_dir="$unmatched_out_dir/lane_$lane"
-            metric_out_dir="$metric_out_dir/lane_$lane"
-            barcode_out_dir="$barcode_out_dir/lane_$lane/"
+    # Demux several lanes at once when the instance has room: by default one
+    # lane per 4 cores and 7GB of memory. The 90% of memory given to java is
+    # split between the concurrent lanes.
+    total_mem_in_mb=`head -n1 /proc/meminfo | awk '{print int($2/1024)}'`
+    if [ -z "$parallel_lanes" ]; then
+        parallel_lanes=$(( $(nproc) / 4 ))
+        if [ $(( total_mem_in_mb / 7000 )) -lt $parallel_lanes ]; then
+            parallel_lanes=$(( total_mem_in_mb / 7000 ))
         fi
+    fi
+    if [ "$parallel_lanes" -gt "${#lanes[@]}" ]; then
+        parallel_lanes=${#lanes[@]}
+    fi
+    if [ "$parallel_lanes" -lt 1 ]; then
+        parallel_lanes=1
+    fi
+    mem_in_mb="$(( total_mem_in_mb * 9 / 10 / parallel_lanes ))m"
 
-        mkdir -p $bam_out_dir
-        mkdir -p $metric_out_dir
-        mkdir -p $unmatched_out_dir
-        mkdir -p $barcode_out_dir
-
-        if [ ${#opts[@]} -eq 0 ]; then
-            viral-ngs illumina.py illumina_demux \
-            "/user-data/$location_of_input" "$lane" "/user-data/$bam_out_dir" \
-            --outMetrics "/user-data/$metric_out_dir/$metrics_fn" \
-            --commonBarcodes "/user-data/$barcode_out_dir/$barcodes_fn" \
-            --JVMmemory "$mem_in_mb"
-        else
-            # Execute viral-ngs demux, $opts is guaranteed to be
-            # not empty, so we can safely quote it without introducing
-            # extraneous quotes
-            echo "${opts[@]}"
-            viral-ngs illumina.py illumina_demux \
-            "/user-data/$location_of_input" "$lane" "/user-data/$bam_out_dir" \
-            --outMetrics "/user-data/$metric_out_dir/$metrics_fn" \
-            --commonBarcodes "/user-data/$barcode_out_dir/$barcodes_fn" \
-            --JVMmemory "$mem_in_mb" "${opts[@]}"
-        fi
+    for ((start = 0; start < ${#lanes[@]}; start += parallel_lanes)); do
+        pids=()
+        for lane in "${lanes[@]:start:parallel_lanes}"; do
+            demux_lane "$lane" > "demux_lane_$lane.log" 2>&1 & pids+=($!)
+        done
+        for i in "${!pids[@]}"; do
+            lane=${lanes[$(( start + i ))]}
+            if ! wait ${pids[$i]}; then
+                cat "demux_lane_$lane.log"
+                dx-jobutil-report-error "Demultiplexing lane $lane failed" AppError
+                exit 1
+            fi
+            cat "demux_lane_$lane.log"
+        done
+    done
 
-        # Move unmatched bam file to unmatched_out_dir, if present
-        if [ -f "$bam_out_dir/Unmatched.bam" ]; then
-            mv "$bam_out_dir/Unmatched.bam" "$unmatched_out_dir/"
+    # Check that demuxed files are not empty (have 0 reads), all at once.
+    # Remove bam files that are empty to prevent potential issues
+    # Dowstream that don't handle empty bam files elegantly
+    find out/bams -type f -name "*.bam" -print0 \
+        | xargs -0 -r -n 1 -P `nproc` sh -c 'n=$(samtools view -c "$0") && echo "$n $0"' > read_counts.txt
+    while read read_count bam_file; do
+        if [ $read_count -eq 0 ]; then
+            echo "===WARNING=== No reads found in demuxed bam file: $bam_file. This file will be removed from output"
+            # Remove empty file
+            rm "$bam_file"
         fi
-
-        # Check that demuxed file is not empty (has 0 reads).
-        # Remove bam file if it's empty to prevent potential issues
-        # Dowstream that don't handle empty bam files elegantly
-        for bam_file in `ls $bam_out_dir`
-        do
-            read_count=`("samtools" view -c "$bam_out_dir/$bam_file")`
-
-            if [ $read_count -eq 0 ]; then
-                echo "===WARNING=== No reads found in demuxed bam file: $bam_file. This file will be removed from output"
-                # Remove empty file
-                rm "$bam_out_dir/$bam_file"
-            fi
+    done < read_counts.txt
+
+    # Per sample output, make output sub-folder for each sample
+    if [ "$per_sample_output" = 'true' ]; then
+        for bam_file in $(find out/bams -type f -name "*.bam"); do
+            sample_name=$(basename "${bam_file%.bam}")
+            mkdir -p "$(dirname $bam_file)/$sample_name"
+            mv "$bam_file" "$(dirname $bam_file)/$sample_name/"
         done
+    fi
 
-        # Per sample output, make output sub-folder for each sample
-        if [ "$per_sample_output" = 'true' ]; then
-            for file in `ls $bam_out_dir`
-            do
-                sample_name="${file%.bam}"
-                mkdir -p "$bam_out_dir/$sample_name"
-                mv "$bam_out_dir/$file" "$bam_out_dir/$sample_name/$file"
-            done
+    # Upload the outputs, with the flowcell and lane properties attached as
+    # they're created; one upload per output folder, 8 at a time
+    find out -type f -printf '%h\n' | sort -u > upload_dirs.txt
+    pids=()
+    n=0
+    while read dir; do
+        upload_dir "$dir" > "upload_ids_$n.txt" & pids+=($!)
+        n=$(( n + 1 ))
+        if [ ${#pids[@]} -ge 8 ]; then
+            for pid in "${pids[@]}"; do wait $pid || exit $?; done
+            pids=()
         fi
+    done < upload_dirs.txt
+    for pid in "${pids[@]}"; do wait $pid || exit $?; done
+
+    cat upload_ids_*.txt | while read field dxid; do
+        dx-jobutil-add-output "$field" --class=array:file "$dxid"
+    done
+}
+
+# stage_run_tarballs <file ID>...
+# Fetches and unpacks the run tarballs into ./input. After checking (in a
+# single describe call) that every one listed exists and is closed and not
+# empty, up to 8 are streamed at a time,
+# each into its own staging folder. The staging folders are then hard-linked
+# into ./input in the given order, so files from a later tarball replace
+# those from an earlier one just as untarring them in sequence would.
+stage_run_tarballs() {
+    local file_ids=("$@")
+    printf '%s\n' "${file_ids[@]}" | jq -R . | jq -s '{objects: .}' > tarballs_input.json
+    dx api system describeDataObjects --input tarballs_input.json > tarballs.json
+    local found_tarballs=($(jq -r '.results[].describe.id // empty' tarballs.json))
+    local missing_tarballs=$(printf '%s\n' "${file_ids[@]}" | grep -vxF -f <(printf '%s\n' "${found_tarballs[@]}") || true)
+    if [ -n "$missing_tarballs" ]; then
+        dx-jobutil-report-error "${#found_tarballs[@]} of ${#file_ids[@]} run tarball(s) found, missing or inaccessible: $(echo $missing_tarballs)" AppError
+        exit 1
+    fi
+    local open_tarballs=$(jq -r '.results[].describe | select(.state != "closed") | .id' tarballs.json)
+    if [ -n "$open_tarballs" ]; then
+        dx-jobutil-report-error "Run tarball(s) not yet closed, the upload may be incomplete: $(echo $open_tarballs)" AppError
+        exit 1
+    fi
+    local empty_tarballs=$(jq -r '.results[].describe | select(.size == 0) | .id' tarballs.json)
+    if [ -n "$empty_tarballs" ]; then
+        dx-jobutil-report-error "Run tarball(s) empty, the upload may be incomplete: $(echo $empty_tarballs)" AppError
+        exit 1
+    fi
+    echo "Staging ${#file_ids[@]} tarball(s), $(jq '[.results[].describe.size] | add' tarballs.json) bytes"
+
+    mkdir -p staging
+    local jobs=$(nproc)
+    if [ $jobs -gt 8 ]; then
+        jobs=8
+    fi
+    local start=$(date +%s)
+    for i in "${!file_ids[@]}"; do
+        echo "$i ${file_ids[$i]}"
+    done | xargs -r -n 2 -P $jobs bash -c 'set -e -o pipefail
+        mkdir -p "staging/$0"
+        dx cat "$1" | pigz -dc | tar xf - -C "staging/$0" --owner root --group root --no-same-owner' \
+        || { dx-jobutil-report-error "Fetching or unpacking a run tarball failed" AppError; exit 1; }
+    echo "Unpacked run tarballs in $(( $(date +%s) - start ))s"
+
+    for i in "${!file_ids[@]}"; do
+        cp -al --remove-destination "staging/$i/." ./input/
+        rm -rf "staging/$i"
     done
+}
 
-    dx-upload-all-outputs
+# demux_lane <lane>
+demux_lane() {
+    local lane="$1"
+
+    # Prepare output folders
+    local bam_out_dir="out/bams"
+    local unmatched_out_dir="out/unmatched_bams"
+    local metric_out_dir="out/metrics"
+    local barcode_out_dir="out/barcodes"
+
+    # Subfolders by lane if multi-lane run
+    if [ "$multi_lane" = true ]; then
+        bam_out_dir="$bam_out_dir/lane_$lane"
+        unmatched_out_dir="$unmatched_out_dir/lane_$lane"
+        metric_out_dir="$metric_out_dir/lane_$lane"
+        barcode_out_dir="$barcode_out_dir/lane_$lane/"
+    fi
 
-    # add flowcell and lane properties to bams
-    for lane in ${lanes[@]}; do
-        bam_out_dir="/"
-        if [ "$multi_lane" = true ]; then
-            bam_out_dir="/lane_$lane"
-        fi
-        for dxfile in $(dx find data --folder "$bam_out_dir" --class file --brief); do
-            if [ -n "$flowcell" ]; then
-                dx set_properties "$dxfile" "flowcell=$flowcell"
-            fi
-            if [ "$multi_lane" = true ]; then
-                dx set_properties "$dxfile" "lane=$lane"
-            fi
-        done
+    mkdir -p $bam_out_dir
+    mkdir -p $metric_out_dir
+    mkdir -p $unmatched_out_dir
+    mkdir -p $barcode_out_dir
+
+    if [ ${#opts[@]} -eq 0 ]; then
+        viral-ngs illumina.py illumina_demux \
+        "/user-data/$location_of_input" "$lane" "/user-data/$bam_out_dir" \
+        --outMetrics "/user-data/$metric_out_dir/$metrics_fn" \
+        --commonBarcodes "/user-data/$barcode_out_dir/$barcodes_fn" \
+        --JVMmemory "$mem_in_mb"
+    else
+        # Execute viral-ngs demux, $opts is guaranteed to be
+        # not empty, so we can safely quote it without introducing
+        # extraneous quotes
+        echo "${opts[@]}"
+        viral-ngs illumina.py illumina_demux \
+        "/user-data/$location_of_input" "$lane" "/user-data/$bam_out_dir" \
+        --outMetrics "/user-data/$metric_out_dir/$metrics_fn" \
+        --commonBarcodes "/user-data/$barcode_out_dir/$barcodes_fn" \
+        --JVMmemory "$mem_in_mb" "${opts[@]}"
+    fi
+
+    # Move unmatched bam file to unmatched_out_dir, if present
+    if [ -f "$bam_out_dir/Unmatched.bam" ]; then
+        mv "$bam_out_dir/Unmatched.bam" "$unmatched_out_dir/"
+    fi
+}
+
+# upload_dir out/<output field>/[lane_N/][sample/]
+# Uploads the files in one output folder to the matching folder (the path
+# after the field name, as dx-upload-all-outputs would), with the flowcell
+# property and, on multi-lane runs, the lane property. Prints the output
+# field and ID of each file.
+upload_dir() {
+    local dir="$1"
+    local field="${dir#out/}"
+    field="${field%%/*}"
+    local dest="${dir#out/$field}"
+    local props=()
+    if [ -n "$flowcell" ]; then
+        props+=(--property "flowcell=$flowcell")
+    fi
+    if [ "$multi_lane" = true ]; then
+        local lane=$(echo "$dest" | grep -Po '(?<=^/lane_)[0-9]+')
+        props+=(--property "lane=$lane")
+    fi
+    local files=()
+    mapfile -t files < <(find "$dir" -maxdepth 1 -type f)
+    for dxid in $(dx upload --brief -p --destination "$dest/" "${props[@]}" "${files[@]}"); do
+        echo "$field $dxid"
     done
 }
@@ -10,11 +10,96 @@ main() {
         opts="-i skip_depletion=true"
     fi
 
-    for bam in "${bams[@]}"; do
-        bam_name=$(dx describe --name "$bam")
-        job=$(dx run $depletion_applet_id -i "file=$bam" \
+    # names and sizes of all the BAMs, in one API call
+    jq '{objects: [.bams[]["$dnanexus_link"] | if type == "object" then .id else . end]}' \
+        ~/job_input.json > describe_input.json
+    dx api system describeDataObjects --input describe_input.json > bams.json
+    mapfile -t bam_ids < <(jq -r '.results[].describe.id' bams.json)
+    mapfile -t bam_names < <(jq -r '.results[].describe.name' bams.json)
+    mapfile -t bam_sizes < <(jq -r '.results[].describe.size' bams.json)
+    if [ -n "$instance_model" ]; then
+        dx cat "$instance_model" > instance_model.json
+        # the model never picks smaller than the depletion applet's own default
+        default_instance_type=$(dx describe "$depletion_applet_id" --json | jq -r .runSpec.systemRequirements.main.instanceType)
+    fi
+
+    # Group the BAMs into depletion jobs, one line of input indices per job.
+    # With a batch budget, BAMs under it are packed first-fit decreasing into
+    # jobs totalling at most batch_size_mb (and batch_max_samples BAMs), so
+    # they share one staging of the resources and databases; larger BAMs get
+    # a job of their own. Without one, every BAM gets its own job.
+    jq -r '.results[].describe.size' bams.json | python -c '
+import sys
+budget, max_samples = int(sys.argv[1]) << 20, max(int(sys.argv[2]), 1)
+sizes = [int(line) for line in sys.stdin]
+bins = []
+for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+    for b in bins:
+        if sizes[i] < budget and b[0] + sizes[i] <= budget and len(b[1]) < max_samples:
+            b[0] += sizes[i]
+            b[1].append(i)
+            break
+    else:
+        bins.append([sizes[i], [i]])
+for _, members in sorted(bins, key=lambda b: min(b[1])):
+    print(" ".join(str(i) for i in sorted(members)))
+' "$batch_size_mb" "$batch_max_samples" > bins.txt
+    cat bins.txt
+
+    # the job depleting each BAM, and for all but the first BAM in a job, its
+    # index in the job's batch_files
+    bam_jobs=()
+    batch_index=()
+    while read -a bin; do
+        first=${bin[0]}
+        batch_opts=()
+        name="deplete ${bam_names[$first]}"
+        if [ "${#bin[@]}" -gt 1 ]; then
+            for i in "${bin[@]:1}"; do
+                batch_opts+=(-i "batch_files=${bam_ids[$i]}")
+            done
+            name="$name and $(( ${#bin[@]} - 1 )) more"
+        fi
+
+        # the job's input features are recorded on it for fitting the sizing
+        # model (util-scripts/fit_instance_model.py); given a model, the job
+        # runs on the cheapest instance type predicted to suit them
+        input_bytes=0
+        for i in "${bin[@]}"; do
+            input_bytes=$(( input_bytes + ${bam_sizes[$i]} ))
+        done
+        features=(input_bytes=$input_bytes sample_count=${#bin[@]})
+        instance_opts=()
+        if [ -n "$instance_model" ] && instance_type=$(viral-ngs-instance-type --model instance_model.json --at-least "$default_instance_type" \
+                viral-ngs-human-depletion "${features[@]}"); then
+            instance_opts=(--instance-type "$instance_type")
+        fi
+
+        job=$(dx run $depletion_applet_id -i "file=${bam_ids[$first]}" "${batch_opts[@]}" \
         -i "resources=$resources" -i "per_sample_output=$per_sample_output" \
-        $opts --name "deplete $bam_name" -y --brief)
-        dx-jobutil-add-output --class=array:jobref cleaned_reads $job:cleaned_reads
+        "${features[@]/#/--property=}" "${instance_opts[@]}" \
+        $opts --name "$name" -y --brief)
+        k=0
+        for i in "${bin[@]}"; do
+            bam_jobs[$i]=$job
+            if [ "$i" != "$first" ]; then
+                batch_index[$i]=$k
+                k=$(( k + 1 ))
+            fi
+        done
+    done < bins.txt
+
+    # outputs stay in the order of the input BAMs: each is the job's own
+    # output for the first BAM in a job, and the element of its batch_
+    # counterpart for the rest
+    for field in cleaned_reads predepletion_read_count predepletion_base_count depleted_read_count depleted_base_count; do
+        for i in "${!bam_ids[@]}"; do
+            if [ -z "${batch_index[$i]}" ]; then
+                dx-jobutil-add-output --class=array:jobref "$field" "${bam_jobs[$i]}:$field"
+            else
+                dx-jobutil-add-output --class=array:auto "$field" \
+                    "{\"\$dnanexus_link\": {\"job\": \"${bam_jobs[$i]}\", \"field\": \"batch_$field\", \"index\": ${batch_index[$i]}}}"
+            fi
+        done
     done
 }
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import re
+import sys
+
+import dxpy
+
+# features the launchers record for each sized executable; the first is the
+# one memory and disk needs are scaled by
+default_features = {
+    "viral-ngs-demux": ["tile_cycles", "total_tile_count"],
+    "viral-ngs-human-depletion": ["input_bytes", "sample_count"]
+}
+
+parser = argparse.ArgumentParser(
+            description="""Fit the instance sizing model used by viral-ngs-instance-type (see
+                        shared-resources/) to past jobs in a project. Launchers record the input
+                        features of the jobs they start as job properties; run times come from
+                        finished jobs, and memory and disk needs from the instance types jobs
+                        succeeded on and from jobs that ran out of memory or disk."""
+            )
+parser.add_argument('project', help='Project whose jobs to fit the model to (project-<ID>).')
+parser.add_argument('model', help='Path of the model JSON to write.')
+parser.add_argument('--executable', dest='executables', nargs='+', default=None,
+                    help="Executable names to fit, with the features to use as NAME:FEATURE,FEATURE,... The first feature is the one memory and disk are scaled by. Default: {}".format(
+                        " ".join("{}:{}".format(name, ",".join(features)) for name, features in sorted(default_features.items()))))
+parser.add_argument('--base', dest='base', type=argparse.FileType('r'), default=None, help="Existing model to update; entries for executables not fitted, and instance type prices, are kept.")
+parser.add_argument('--prices', dest='prices', type=argparse.FileType('r'), default=None, help="JSON object of instance type: hourly price, for instance types not seen among the jobs.")
+parser.add_argument('--maxHours', dest='max_hours', type=float, default=12, help="Run time limit, in hours, an instance type is chosen to meet (default: %(default)s).")
+parser.add_argument('--margin', dest='margin', type=float, default=1.2, help="Factor applied to the memory and disk of an instance type a job ran out of (default: %(default)s).")
+
+# cores, memory (GB) and local disk (GB) of DNAnexus instance types
+instance_hardware = {
+    "mem1_ssd1_x2": (2, 3.8, 32), "mem1_ssd1_x4": (4, 7.5, 80), "mem1_ssd1_x8": (8, 15, 160),
+    "mem1_ssd1_x16": (16, 30, 320), "mem1_ssd1_x32": (32, 60, 640),
+    "mem1_ssd2_x2": (2, 3.8, 160), "mem1_ssd2_x4": (4, 7.5, 320), "mem1_ssd2_x8": (8, 15, 640),
+    "mem1_ssd2_x16": (16, 30, 1280), "mem1_ssd2_x36": (36, 60, 2880),
+    "mem1_hdd2_x8": (8, 7, 1680), "mem1_hdd2_x32": (32, 60, 3360),
+    "mem2_ssd1_x2": (2, 7.5, 32), "mem2_ssd1_x4": (4, 15, 80), "mem2_ssd1_x8": (8, 30, 160),
+    "mem2_ssd1_x16": (16, 60, 320), "mem2_ssd1_x32": (32, 120, 640),
+    "mem2_hdd2_x1": (1, 3.8, 410), "mem2_hdd2_x2": (2, 7.5, 840), "mem2_hdd2_x4": (4, 15, 1680),
+    "mem3_ssd1_x2": (2, 15, 32), "mem3_ssd1_x4": (4, 30, 80), "mem3_ssd1_x8": (8, 61, 160),
+    "mem3_ssd1_x16": (16, 122, 320), "mem3_ssd1_x32": (32, 244, 640),
+    "mem3_hdd2_x2": (2, 15, 420), "mem3_hdd2_x4": (4, 30, 840), "mem3_hdd2_x8": (8, 61, 1680)
+}
+
+# failure messages of jobs that ran out of memory or disk
+out_of_memory = re.compile(r"out of memory|OutOfMemoryError|Cannot allocate memory", re.IGNORECASE)
+out_of_disk = re.compile(r"No space left on device|disk (is )?full", re.IGNORECASE)
+
+def run_seconds(job):
+    if job.get("startedRunning") and job.get("stoppedRunning"):
+        return (job["stoppedRunning"] - job["startedRunning"])/1000.0
+    return None
+
+def job_features(job, names):
+    """The job's recorded features, by name, or None if any is missing."""
+    properties = job.get("properties") or {}
+    try:
+        return dict((name, float(properties[name])) for name in names)
+    except (KeyError, ValueError):
+        return None
+
+def nonnegative_least_squares(rows, targets, sweeps=2000):
+    """
+    Coefficients x >= 0 minimizing |rows.x - targets|, by coordinate descent
+    on the normal equations (the problems here have a handful of columns).
+    """
+    n = len(rows[0])
+    ata = [[sum(r[i]*r[j] for r in rows) for j in range(n)] for i in range(n)]
+    atb = [sum(r[i]*t for r, t in zip(rows, targets)) for i in range(n)]
+    x = [0.0]*n
+    for _ in range(sweeps):
+        for i in range(n):
+            if ata[i][i] > 0:
+                residual = atb[i] - sum(ata[i][j]*x[j] for j in range(n) if j != i)
+                x[i] = max(0.0, residual/ata[i][i])
+    return x
+
+def fit_runtime(samples, names):
+    """
+    serialSeconds and parallelSeconds predictors from (features, cores,
+    seconds) samples: seconds ~ serial(features) + parallel(features)/cores.
+    Each feature is scaled to at most 1 while fitting.
+    """
+    scale = dict((name, max(abs(f[name]) for f, _, _ in samples) or 1.0) for name in names)
+    rows = []
+    for features, cores, _ in samples:
+        scaled = [1.0] + [features[name]/scale[name] for name in names]
+        rows.append(scaled + [x/cores for x in scaled])
+    x = nonnegative_least_squares(rows, [seconds for _, _, seconds in samples])
+    def predictor(coefficients):
+        result = {"intercept": coefficients[0]}
+        result.update((name, c/scale[name]) for name, c in zip(names, coefficients[1:]))
+        return result
+    return predictor(x[:len(names)+1]), predictor(x[len(names)+1:])
+
+def fit_requirement(succeeded, failed, margin):
+    """
+    Linear requirement, (intercept GB, GB per unit of the sizing feature),
+    from the (feature, capacity) of jobs that succeeded, whose instance was
+    big enough, and of jobs that ran out, whose instance wasn't. The
+    intercept covers the fixed footprint (databases, JVM heap) that doesn't
+    shrink with the input: the smallest capacity any job succeeded with, or
+    margin times the largest that ran out if none succeeded. The slope is
+    the steepest from the intercept that stays within the capacity of every
+    job that succeeded on a bigger instance, raised as needed to reach
+    margin times the capacity of every job that ran out. None without any
+    samples.
+    """
+    if not succeeded and not failed:
+        return None
+    if succeeded:
+        intercept = min(capacity for _, capacity in succeeded)
+    else:
+        intercept = margin*max(capacity for _, capacity in failed)
+    enough = [(capacity - intercept)/feature for feature, capacity in succeeded if feature > 0 and capacity > intercept]
+    too_little = [(margin*capacity - intercept)/feature for feature, capacity in failed if feature > 0]
+    slope = min(enough) if enough else 0.0
+    if too_little:
+        slope = max(slope, max(too_little))
+    return intercept, slope
+
+def fit_executable(jobs, name, features, args):
+    """
+    The model entry for an executable, and the hourly prices seen for each
+    instance type, from the describe hashes of its done and failed jobs.
+    """
+    print("{}: {} finished or failed jobs".format(name, len(jobs)))
+
+    runtime_samples, prices, featured = [], {}, 0
+    memory_ok, memory_failed, disk_ok, disk_failed = [], [], [], []
+    for job in jobs:
+        hardware = instance_hardware.get(job.get("instanceType"))
+        values = job_features(job, features)
+        seconds = run_seconds(job)
+        if job["state"] == "done" and seconds and job.get("totalPrice") is not None:
+            prices.setdefault(job["instanceType"], []).append(job["totalPrice"]/(seconds/3600.0))
+        if hardware is None or values is None:
+            continue
+        cores, memory, disk = hardware
+        size = values[features[0]]
+        featured += 1
+        if job["state"] == "done":
+            if seconds:
+                runtime_samples.append((values, cores, seconds))
+            memory_ok.append((size, memory))
+            disk_ok.append((size, disk))
+        else:
+            message = "{} {}".format(job.get("failureReason", ""), job.get("failureMessage", ""))
+            if out_of_memory.search(message):
+                memory_failed.append((size, memory))
+            if out_of_disk.search(message):
+                disk_failed.append((size, disk))
+    print("{}: {} jobs with recorded features ({} out of memory, {} out of disk)".format(
+          name, featured, len(memory_failed), len(disk_failed)))
+
+    entry = {"features": features, "maxHours": args.max_hours, "jobs": len(runtime_samples)}
+    if len(runtime_samples) > len(features) + 1:
+        entry["serialSeconds"], entry["parallelSeconds"] = fit_runtime(runtime_samples, features)
+    for key, succeeded, failed in (("memoryGB", memory_ok, memory_failed), ("diskGB", disk_ok, disk_failed)):
+        requirement = fit_requirement(succeeded, failed, args.margin)
+        if requirement is not None:
+            entry[key] = {"intercept": requirement[0], features[0]: requirement[1]}
+    return entry, prices
+
+if __name__ == "__main__":
+    if len(sys.argv)==1:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    model = json.load(args.base) if args.base else {}
+    model.setdefault("executables", {})
+    model.setdefault("instanceTypes", {})
+    given_prices = json.load(args.prices) if args.prices else {}
+
+    executables = dict(default_features)
+    if args.executables:
+        executables = {}
+        for spec in args.executables:
+            name, _, features = spec.partition(":")
+            executables[name] = features.split(",") if features else default_features[name]
+
+    print("Reading jobs...")
+    jobs = dict((name, []) for name in executables)
+    for state in ("done", "failed"):
+        for result in dxpy.find_executions(project=args.project, classname="job", state=state, describe=True):
+            if result["describe"].get("executableName") in jobs:
+                jobs[result["describe"]["executableName"]].append(result["describe"])
+
+    observed_prices = {}
+    for name, features in sorted(executables.items()):
+        model["executables"][name], prices = fit_executable(jobs[name], name, features, args)
+        for instance_type, values in prices.items():
+            observed_prices.setdefault(instance_type, []).extend(values)
+
+    for instance_type, (cores, memory, disk) in instance_hardware.items():
+        spec = model["instanceTypes"].setdefault(instance_type, {})
+        spec.update({"cores": cores, "memoryGB": memory, "diskGB": disk})
+        if instance_type in observed_prices:
+            values = sorted(observed_prices[instance_type])
+            spec["hourlyPrice"] = round(values[len(values)//2], 4)
+        elif instance_type in given_prices:
+            spec["hourlyPrice"] = given_prices[instance_type]
+
+    with open(args.model, "w") as outfile:
+        json.dump(model, outfile, indent=2, sort_keys=True)
+    print("Model written for {} executable(s); {} instance types priced.".format(
+          len(executables), len([x for x in model["instanceTypes"].values() if x.get("hourlyPrice") is not None])))
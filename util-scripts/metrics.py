@@ -6,6 +6,9 @@ import sys
 import concurrent.futures
 import datetime
 import re
+import json
+import sqlite3
+import tempfile
 import multiprocessing
 
 import dxpy
@@ -21,6 +24,10 @@ parser.add_argument('ids', type=str, nargs='+', help='IDs for which information
 parser.add_argument('--state', dest='states', nargs='+', choices=["done", "failed", "running", "terminated", "runnable"], default=None, help="Execution states to include when returning information for all jobs or analyses in a project. Note: 'runnable' means the item is waiting to be executed.")
 parser.add_argument('--executableName', dest='executable_names', nargs='+', default=None, help="DNAnexus executable names to include. If omitted, all are included.")
 parser.add_argument('--noDescendants', dest='no_descendants', action='store_true', help="Include top-level executions only. This is helpful when specifying a project-ID and child jobs are not desired in the output.")
+parser.add_argument('--columns', dest='columns', nargs='+', default=None, help="Columns to write, in order. Rows are then written as executions are read; otherwise the columns are all those seen, and the rows are written once every execution has been read.")
+parser.add_argument('--report', dest='report', action='store_true', help="Instead of output metrics, write one row per stage (and per job launched by a stage) of each analysis, with its queue and run times, instance type and price, and print each analysis' critical path and a per-workflow summary.")
+parser.add_argument('--top', dest='top', type=int, default=3, help="Number of most expensive stages to list per workflow in --report mode (default: %(default)s).")
+parser.add_argument('--sync', dest='sync', metavar='DB', default=None, help="SQLite file accumulating execution metrics. Only executions created since the last sync (or still unfinished then) are read from DNAnexus; the CSV is then written from the file.")
 
 def available_cpu_count():
     """
@@ -44,65 +51,369 @@ def available_cpu_count():
 
     return multiprocessing.cpu_count()
 
-if __name__ == "__main__":
-    if len(sys.argv)==1:
-        parser.print_help()
-        sys.exit(0)
-
-    args = parser.parse_args()
-
+def iter_executions(args):
+    """
+    Yield describe hashes of the requested executions as they're read: those
+    in each project come with their find_executions results, and explicitly
+    given IDs are described concurrently. Each execution is yielded once.
+    """
     analysis_ids = filter(lambda s: s.startswith("analysis-"), args.ids)
     project_ids  = filter(lambda s: s.startswith("project-"),  args.ids)
     job_ids      = filter(lambda s: s.startswith("job-"),      args.ids)
 
-    executions = []
+    seen = set()
+    for project_id in project_ids:
+        for state in (args.states or [None]):
+            for result in dxpy.find_executions(project=project_id, state=state, describe=True,
+                                               no_parent_analysis=args.no_descendants):
+                if result["id"] not in seen:
+                    seen.add(result["id"])
+                    yield result["describe"]
+
+    execution_ids_to_describe = [x for x in set(analysis_ids+job_ids) if x not in seen]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=available_cpu_count()) as executor:
+        for execution in executor.map(dxpy.describe, execution_ids_to_describe):
+            yield execution
+
+def included(metrics, args):
+    """
+    Whether an execution's row passes the --state, --executableName and
+    --noDescendants filters.
+    """
+    if args.states:
+        if "state" in metrics and metrics["state"] not in args.states:
+            return False
+    if args.no_descendants:
+        if "parentAnalysis" in metrics and metrics["parentAnalysis"] is not None:
+            return False
+    if args.executable_names:
+        if "executableName" in metrics and metrics["executableName"] not in args.executable_names:
+            return False
+    return True
+
+def execution_metrics(execution):
+    """
+    The CSV row for an execution's describe hash.
+    """
+    metrics=dict([(x,execution[x]) for x in top_level_execution_attributes_to_include if x in execution])
+    metrics["created"] = datetime.datetime.utcfromtimestamp(float(execution["created"])/1000).isoformat()
+
+    for execution_key in ["output"]:
+        if execution_key in execution and execution[execution_key] is not None:
+            for key, value in execution[execution_key].items():
+                if type(value) == int:
+                    field_name=key.split(".")[-1]
+                    metrics[field_name] = value
 
-    project_job_ids = []
-    if project_ids:
-        for project_id in project_ids:
-            if args.states:
-                for state in args.states:
-                    project_job_ids.extend([e["id"] for e in dxpy.find_executions(project=project_id, state=state)])
-            else:
-                project_job_ids.extend([e["id"] for e in dxpy.find_executions(project=project_id)])
+    return metrics
 
-    execution_ids_to_describe = list(set(analysis_ids+project_job_ids+job_ids))
+# states after which an execution no longer changes
+terminal_states = ("done", "failed", "terminated")
 
-    print("Reading {} total executions...".format(len(execution_ids_to_describe)))
+def open_store(path):
+    store = sqlite3.connect(path)
+    store.execute("""CREATE TABLE IF NOT EXISTS executions (
+                         id TEXT PRIMARY KEY,
+                         project TEXT NOT NULL,
+                         created INTEGER NOT NULL,
+                         state TEXT NOT NULL,
+                         metrics_json TEXT NOT NULL)""")
+    store.execute("CREATE INDEX IF NOT EXISTS executions_project_created ON executions (project, created)")
+    store.commit()
+    return store
 
+# how far before the newest stored execution each sync reads a project again,
+# for executions created just before the last sync but not yet listed by it
+sync_overlap_ms = 10 * 60 * 1000
+
+# executions described per /system/describeExecutions call
+describe_batch_size = 1000
+
+def sync_cursor(store, project_id):
+    """
+    Creation time to read a project's new executions from: that of the
+    newest stored one, less sync_overlap_ms. (find_executions can't select
+    by modification time, so stored executions which may still change are
+    re-described by ID instead.) None if nothing is stored for the project
+    yet.
+    """
+    newest = store.execute("SELECT MAX(created) FROM executions WHERE project = ?", (project_id,)).fetchone()[0]
+    return newest - sync_overlap_ms if newest is not None else None
+
+def describe_executions(execution_ids):
+    """
+    Yield describe hashes of the given executions, describe_batch_size per
+    /system/describeExecutions call, with the batches described concurrently.
+    """
+    execution_ids = list(execution_ids)
+    batches = [execution_ids[i:i + describe_batch_size] for i in range(0, len(execution_ids), describe_batch_size)]
+    def describe(batch):
+        return dxpy.api.system_describe_executions({"executions": batch})["results"]
     with concurrent.futures.ThreadPoolExecutor(max_workers=available_cpu_count()) as executor:
-        for execution in executor.map(dxpy.describe, execution_ids_to_describe, chunksize=50):
-            executions.append(execution)
-
-    all_metrics = []
-    keys_seen = set()
-    for execution in executions:
-        metrics = {}
-
-        if args.no_descendants:
-            if "parentAnalysis" in execution and execution["parentAnalysis"] is not None:
-                continue
-        if args.executable_names:
-            if "executableName" in execution and execution["executableName"] not in args.executable_names:
-                continue
-
-        metrics=dict([(x,execution[x]) for x in top_level_execution_attributes_to_include if x in execution])
-        metrics["created"] = datetime.datetime.utcfromtimestamp(float(execution["created"])/1000).isoformat()
-        keys_seen.update(metrics.keys())
-
-        for execution_key in ["output"]:
-            if execution_key in execution and execution[execution_key] is not None:
-                for key, value in execution[execution_key].items():
-                    if type(value) == int:
-                        field_name=key.split(".")[-1]
-                        metrics[field_name] = value
-                        keys_seen.add(field_name)
-
-        all_metrics.append(metrics)
+        for results in executor.map(describe, batches):
+            for result in results:
+                if "describe" in result:
+                    yield result["describe"]
+
+def sync_store(store, args):
+    """
+    Bring the store up to date with the projects and executions in args.ids:
+    each project's executions created since the last sync are read with a
+    single find_executions query, and its stored unfinished ones are
+    re-described by ID in batches (the --state and other filters are applied
+    when exporting). Returns the number of executions added or changed.
+    """
+    project_ids = filter(lambda s: s.startswith("project-"), args.ids)
+    execution_ids = filter(lambda s: s.startswith("analysis-") or s.startswith("job-"), args.ids)
+
+    def store_execution(execution):
+        previous = store.execute("SELECT state FROM executions WHERE id = ?", (execution["id"],)).fetchone()
+        store.execute("INSERT OR REPLACE INTO executions (id, project, created, state, metrics_json) VALUES (?, ?, ?, ?, ?)",
+                      (execution["id"], execution["project"], execution["created"], execution["state"],
+                       json.dumps(execution_metrics(execution))))
+        return previous is None or previous[0] != execution["state"]
+
+    changed = 0
+    for project_id in project_ids:
+        cursor = sync_cursor(store, project_id)
+        stale = set(row[0] for row in store.execute("SELECT id FROM executions WHERE project = ? AND state NOT IN (?, ?, ?)",
+                                                    (project_id,) + terminal_states))
+        # executions read again in the overlap are just updated
+        for result in dxpy.find_executions(project=project_id, describe=True, created_after=cursor):
+            stale.discard(result["id"])
+            if store_execution(result["describe"]):
+                changed += 1
+        for execution in describe_executions(stale):
+            if store_execution(execution):
+                changed += 1
+        store.commit()
+
+    # explicitly given executions only need describing if unfinished or new
+    finished = set()
+    for execution_id in execution_ids:
+        row = store.execute("SELECT state FROM executions WHERE id = ?", (execution_id,)).fetchone()
+        if row is not None and row[0] in terminal_states:
+            finished.add(execution_id)
+    for execution in describe_executions(x for x in set(execution_ids) if x not in finished):
+        if store_execution(execution):
+            changed += 1
+    store.commit()
+    return changed
+
+def stored_metrics(store, args):
+    """
+    Yield the stored rows of the projects and executions in args.ids, oldest
+    first.
+    """
+    ids = list(set(args.ids))
+    placeholders = ", ".join("?" * len(ids))
+    query = "SELECT metrics_json FROM executions WHERE project IN ({0}) OR id IN ({0}) ORDER BY created".format(placeholders)
+    for (metrics_json,) in store.execute(query, ids + ids):
+        yield json.loads(metrics_json)
+
+report_columns = ['analysis', 'analysisName', 'workflow', 'stage', 'stageName', 'job', 'executableName',
+                  'instanceType', 'state', 'dependsOn', 'queueSeconds', 'runSeconds', 'finishedSeconds',
+                  'price', 'criticalPath']
 
+def iter_links(value):
+    """
+    Yield the targets of all DNAnexus links within an input hash.
+    """
+    if isinstance(value, dict):
+        if "$dnanexus_link" in value:
+            if isinstance(value["$dnanexus_link"], dict):
+                yield value["$dnanexus_link"]
+        else:
+            for v in value.values():
+                for link in iter_links(v):
+                    yield link
+    elif isinstance(value, list):
+        for v in value:
+            for link in iter_links(v):
+                yield link
+
+def job_timing(job):
+    """
+    (ready, started, stopped, finished) times, in seconds since the epoch, of
+    a job describe hash: when it became runnable (all inputs available),
+    started and stopped running, and reached a final state (which for a job
+    with children can be well after it stopped). Any may be None.
+    """
+    transitions = [(t["newState"], t["setAt"]) for t in job.get("stateTransitions", [])]
+    started = job.get("startedRunning")
+    ready = [at for state, at in transitions if state == "runnable" and (started is None or at <= started)]
+    ready = ready[-1] if ready else job.get("created")
+    finished = [at for state, at in transitions if state in terminal_states]
+    finished = finished[-1] if finished else job.get("stoppedRunning")
+    return tuple(None if t is None else t/1000.0 for t in (ready, started, job.get("stoppedRunning"), finished))
+
+def difference(later, earlier):
+    return later - earlier if later is not None and earlier is not None else None
+
+def analysis_report(analysis):
+    """
+    Rebuild an analysis' stage graph, including the jobs its stages launch,
+    from its describe hash and those of all its descendant jobs. Returns
+    report rows (see report_columns), stage rows first in workflow order,
+    and the critical path as a list of stage IDs, from first to last.
+    """
+    workflow_stages = analysis.get("workflow", {}).get("stages", [])
+    stage_names = dict((stage["id"], stage.get("name") or stage["id"]) for stage in workflow_stages)
+    stage_inputs = dict((stage["id"], stage.get("input", {})) for stage in workflow_stages)
+    stage_jobs = dict((stage["id"], stage["execution"]["id"]) for stage in analysis.get("stages", [])
+                      if stage.get("execution"))
+    job_stages = dict((job_id, stage_id) for stage_id, job_id in stage_jobs.items())
+
+    jobs = dict((result["id"], result["describe"]) for result in
+                dxpy.find_executions(root_execution=analysis["id"], classname="job", describe=True))
+
+    # each stage depends on the stages whose outputs its inputs link to
+    depends_on = {}
+    for stage_id, job_id in stage_jobs.items():
+        inputs = [stage_inputs.get(stage_id, {}), jobs.get(job_id, {}).get("originalInput", {})]
+        depends_on[stage_id] = set()
+        for link in iter_links(inputs):
+            upstream = link.get("stage") or job_stages.get(link.get("job"))
+            if upstream in stage_jobs and upstream != stage_id:
+                depends_on[stage_id].add(upstream)
+
+    # the critical path runs back from the last stage to finish, through
+    # whichever stage it depends on finished last
+    finished = dict((stage_id, job_timing(jobs[job_id])[3] if job_id in jobs else None)
+                    for stage_id, job_id in stage_jobs.items())
+    critical_path = []
+    candidates = [stage_id for stage_id in stage_jobs if finished[stage_id] is not None]
+    while candidates:
+        stage_id = max(candidates, key=lambda x: finished[x])
+        critical_path.insert(0, stage_id)
+        candidates = [x for x in depends_on[stage_id] if finished[x] is not None and x not in critical_path]
+
+    # jobs launched by a stage (rather than being one) are attributed to the
+    # stage they descend from
+    def owning_stage(job):
+        while job is not None:
+            if job["id"] in job_stages:
+                return job_stages[job["id"]]
+            job = jobs.get(job.get("parentJob"))
+        return None
+
+    analysis_created = analysis["created"]/1000.0
+    def report_row(stage_id, job, on_critical_path):
+        ready, started, stopped, done = job_timing(job)
+        stage_name = stage_names.get(stage_id, stage_id)
+        if job["id"] not in job_stages:
+            stage_name = "{}/{}".format(stage_name, job.get("executableName") or job.get("name"))
+        return {
+            "analysis": analysis["id"], "analysisName": analysis.get("name"),
+            "workflow": analysis.get("executableName"),
+            "stage": stage_id, "stageName": stage_name,
+            "job": job["id"], "executableName": job.get("executableName"),
+            "instanceType": job.get("instanceType"), "state": job.get("state"),
+            "dependsOn": " ".join(sorted(stage_names.get(x, x) for x in depends_on.get(stage_id, ())))
+                         if job["id"] in job_stages else "",
+            "queueSeconds": difference(started, ready), "runSeconds": difference(stopped, started),
+            "finishedSeconds": difference(done, analysis_created),
+            "price": job.get("totalPrice"), "criticalPath": on_critical_path
+        }
+
+    stage_order = [stage["id"] for stage in workflow_stages if stage["id"] in stage_jobs]
+    rows = [report_row(stage_id, jobs[stage_jobs[stage_id]], stage_id in critical_path)
+            for stage_id in stage_order if stage_jobs[stage_id] in jobs]
+    for job in sorted(jobs.values(), key=lambda job: job["created"]):
+        if job["id"] not in job_stages:
+            stage_id = owning_stage(job)
+            rows.append(report_row(stage_id, job, False))
+    return rows, critical_path
+
+def report(args):
+    analyses = [execution for execution in iter_executions(args)
+                if execution["id"].startswith("analysis-") and included(execution_metrics(execution), args)]
+    print("Reporting on {} analyses...".format(len(analyses)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=available_cpu_count()) as executor:
+        reports = list(executor.map(analysis_report, analyses))
+
+    # per workflow and stage name: run count, total queue and run seconds,
+    # total price, instance types, times on the critical path
+    summary = {}
     with args.csvfile as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=sorted(keys_seen))
+        writer = csv.DictWriter(csvfile, fieldnames=report_columns)
         writer.writeheader()
-        writer.writerows(all_metrics)
+        for analysis, (rows, critical_path) in zip(analyses, reports):
+            writer.writerows(rows)
+
+            path = dict((row["stage"], row) for row in rows if row["criticalPath"])
+            print("{} {} ({}): {}".format(analysis["id"], analysis.get("name"), analysis.get("state"),
+                  " -> ".join("{} ({:.0f}m)".format(path[x]["stageName"], path[x]["finishedSeconds"]/60)
+                              for x in critical_path)))
+
+            for row in rows:
+                stats = summary.setdefault((row["workflow"], row["stageName"]),
+                                           {"n": 0, "queue": 0.0, "run": 0.0, "price": 0.0,
+                                            "instanceTypes": set(), "critical": 0})
+                stats["n"] += 1
+                stats["queue"] += row["queueSeconds"] or 0
+                stats["run"] += row["runSeconds"] or 0
+                stats["price"] += row["price"] or 0
+                stats["critical"] += 1 if row["criticalPath"] else 0
+                if row["instanceType"]:
+                    stats["instanceTypes"].add(row["instanceType"])
+
+    for workflow in sorted(set(workflow for workflow, _ in summary)):
+        stages = sorted(((name, stats) for (w, name), stats in summary.items() if w == workflow),
+                        key=lambda x: x[1]["price"], reverse=True)
+        print("\n{}: most expensive stages".format(workflow))
+        for name, stats in stages[:args.top]:
+            print("\t".join([str(name), "{:.2f} total".format(stats["price"]),
+                             "{} runs".format(stats["n"]),
+                             "{:.1f}m mean queue".format(stats["queue"]/stats["n"]/60),
+                             "{:.1f}m mean run".format(stats["run"]/stats["n"]/60),
+                             "{} on critical path".format(stats["critical"]),
+                             ",".join(sorted(stats["instanceTypes"]))]))
+
+if __name__ == "__main__":
+    if len(sys.argv)==1:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    if args.report:
+        report(args)
+        sys.exit(0)
+
+    if args.sync:
+        store = open_store(args.sync)
+        print("Syncing executions...")
+        print("{} executions new or changed since the last sync.".format(sync_store(store, args)))
+        all_metrics = stored_metrics(store, args)
+    else:
+        print("Reading executions...")
+        all_metrics = (execution_metrics(execution) for execution in iter_executions(args))
+    all_metrics = (m for m in all_metrics if included(m, args))
+    metrics_count = 0
+
+    with args.csvfile as csvfile:
+        if args.columns:
+            # known columns: write each row as soon as it's read
+            writer = csv.DictWriter(csvfile, fieldnames=args.columns, extrasaction='ignore')
+            writer.writeheader()
+            for metrics in all_metrics:
+                writer.writerow(metrics)
+                metrics_count += 1
+        else:
+            # spool the rows to a temporary file while collecting the columns,
+            # then write them out; only the column names are kept in memory
+            keys_seen = set()
+            with tempfile.TemporaryFile() as spool:
+                for metrics in all_metrics:
+                    keys_seen.update(metrics.keys())
+                    spool.write(json.dumps(metrics) + "\n")
+                    metrics_count += 1
+                spool.seek(0)
+                writer = csv.DictWriter(csvfile, fieldnames=sorted(keys_seen))
+                writer.writeheader()
+                for line in spool:
+                    writer.writerow(json.loads(line))
 
-    print("Metrics written for {} execution objects.".format(len(all_metrics)))
+    print("Metrics written for {} execution objects.".format(metrics_count))
@@ -4,7 +4,7 @@ main() {
     set -e -x -o pipefail
     export PATH="$PATH:$HOME/miniconda/bin"
 
-    dx cat "$resources" | zcat | tar x -C /
+    viral-ngs-stage-resources "$resources"
     dx cat "$fastagz" | zcat > input.fasta
 
     mkdir db
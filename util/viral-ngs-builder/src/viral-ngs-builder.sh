@@ -14,10 +14,35 @@ dx-docker run -v \$(pwd):/user-data broadinstitute/viral-ngs$viral_ngs_version \
     chmod +x /usr/local/bin/viral-ngs
     echo /usr/local/bin/viral-ngs >> /tmp/resources-manifest.txt
 
+    # split the image into content-addressed parts, reusing parts of earlier
+    # builds, for viral-ngs-stage-resources to fetch and unpack in parallel;
+    # they're linked from the tarball's details, along with the content of
+    # every other file in the tarball
+    mapfile -t acis < <(find /tmp/dx-docker-cache -type f -name '*.aci')
+    if [ "${#acis[@]}" -ne 1 ]; then
+        dx-jobutil-report-error "Expected one ACI in /tmp/dx-docker-cache after pulling the image, found ${#acis[@]}" AppError
+        exit 1
+    fi
+    file_opts=()
+    while read -r f; do
+        if [ "$f" != "${acis[0]}" ]; then
+            file_opts+=(--file "$f")
+        fi
+    done < /tmp/resources-manifest.txt
+    split_aci "${acis[0]}" "${file_opts[@]}" > /tmp/resources-details.json
+
+    # record the image digest so build_resources_tarball.py can find and
+    # reuse this tarball
+    properties=(--property "viral_ngs_version=$viral_ngs_version")
+    if [ -n "$image_digest" ]; then
+        properties+=(--property "image_digest=$image_digest")
+    fi
+
     # upload a tarball with the new files
     rinsed_version=$(echo "$viral_ngs_version" | tr -d ":@")
-    resources=`tar -c -v -z -T /tmp/resources-manifest.txt | \
-               dx upload --brief -o "viral-ngs-${rinsed_version}.resources.tar.gz" -`
+    resources=`tar -c -v -T /tmp/resources-manifest.txt | pigz -c | \
+               dx upload --brief --details "$(cat /tmp/resources-details.json)" "${properties[@]}" \
+                         -o "viral-ngs-${rinsed_version}.resources.tar.gz" -`
 
     dx-jobutil-add-output resources "$resources" --class=file
 }
@@ -4,7 +4,7 @@ main() {
     set -e -x -o pipefail
 
     accessions=$(echo ${accession_numbers[*]})
-    dx cat "$resources" | pigz -dc | tar x -C /
+    viral-ngs-stage-resources "$resources"
 
     # Write combined fasta to /genome.fasta
 
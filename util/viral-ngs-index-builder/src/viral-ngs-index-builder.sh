@@ -0,0 +1,16 @@
+#!/bin/bash
+
+main() {
+    set -e -x -o pipefail
+
+    pids=()
+    viral-ngs-stage-resources "$resources" & pids+=($!)
+    dx download "$fasta" -o reference.fasta & pids+=($!)
+    for pid in "${pids[@]}"; do wait $pid || exit $?; done
+
+    # build the index, recording what it's keyed by as properties
+    viral-ngs-reference-index --pack index.tar.gz "$kind" reference.fasta "$resources" > index_properties.txt
+    mapfile -t properties < index_properties.txt
+    dxid=$(dx upload index.tar.gz --brief --destination "${fasta_prefix}.${kind}_index.tar.gz" "${properties[@]/#/--property=}")
+    dx-jobutil-add-output index --class=file "$dxid"
+}
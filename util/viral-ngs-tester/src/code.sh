@@ -3,7 +3,7 @@
 main() {
     set -e -x -o pipefail
 
-    dx cat "$resources" | zcat | tar x -C /
+    viral-ngs-stage-resources "$resources"
 
     cd viral-ngs
     ./run_all_tests.sh
@@ -3,97 +3,235 @@
 import sys
 import dxpy
 import argparse
+import copy
 import time
 import subprocess
 import tempfile
 import os
+import json
+import sqlite3
+import random
+import threading
+import concurrent.futures
+import numpy
 from Bio import SeqIO
 
 parser = argparse.ArgumentParser(description="viral-ngs-assembly DNAnexus workflow validation")
 subparsers = parser.add_subparsers()
 
 def launch(args):
-    workflow = dxpy.DXWorkflow(args.workflow)
-    run_id = generate_run_id(workflow)
-    args.folder = args.folder or ("/validation/"+run_id)
+    if not (args.workflow or args.resume):
+        parser.error("launch requires a workflow ID, or --resume with a run record ID")
     project = dxpy.DXProject(args.project)
     muscle_applet = dxpy.DXApplet(args.muscle)
 
-    # find input BAMs from the 'EBOV validation data' project
-    bi_project = "project-BXz7QkQ0K7jf8bQ74GzG9gvY"
-    input_bam_ext = ".cleaned.bam" if args.skip_depletion is True else ".raw.bam"
-    fdo = dxpy.search.find_data_objects
-    bi_input_bams = list(fdo(project=bi_project, folder="/data/01_per_sample", classname="file",
-                             name=("*"+input_bam_ext), name_mode="glob", return_handler=True))
-    bi_input_bams = dict([(strip_end(b.name, input_bam_ext), b) for b in bi_input_bams])
-    print("Found {} input BAMs".format(len(bi_input_bams)))
-
-    # find output assemblies from the 'EBOV validation data' project
-    bi_assemblies = list(fdo(project=bi_project, folder="/data/02_assembly", classname="file",
-                             name="*.fasta", name_mode="glob", return_handler=True))
-    bi_assemblies = dict([(strip_end(f.name, ".fasta"), f) for f in bi_assemblies])
-    print("Found {} output assemblies".format(len(bi_assemblies)))
-
-    run_details = {"id": run_id, "workflow": args.workflow, "samples": {}}
-
-    # join them
-    sample_count = 0
-    for sample, bi_assembly in bi_assemblies.iteritems():
+    if args.resume:
+        # pick up an interrupted launch from its (still open) run record
+        run_record = dxpy.DXRecord(dxpy.dxlink(args.resume, args.project))
+        run_record_desc = run_record.describe()
+        if run_record_desc["state"] == "closed":
+            exit("{} was already launched completely".format(args.resume))
+        run_details = run_record.get_details()
+        run_id = run_details["id"]
+        workflow = dxpy.DXWorkflow(run_details["workflow"])
+        args.folder = run_record_desc["folder"]
+        print("{} resuming launch of {} samples".format(run_id, len(run_details["samples"])))
+    else:
+        workflow = dxpy.DXWorkflow(args.workflow)
+        run_id = generate_run_id(workflow)
+        args.folder = args.folder or ("/validation/"+run_id)
+
+        # find input BAMs from the 'EBOV validation data' project
+        bi_project = "project-BXz7QkQ0K7jf8bQ74GzG9gvY"
+        input_bam_ext = ".cleaned.bam" if args.skip_depletion is True else ".raw.bam"
+        fdo = dxpy.search.find_data_objects
+        bi_input_bams = list(fdo(project=bi_project, folder="/data/01_per_sample", classname="file",
+                                 name=("*"+input_bam_ext), name_mode="glob", return_handler=True))
+        bi_input_bams = dict([(strip_end(b.name, input_bam_ext), b) for b in bi_input_bams])
+        print("Found {} input BAMs".format(len(bi_input_bams)))
+
+        # find output assemblies from the 'EBOV validation data' project
+        bi_assemblies = list(fdo(project=bi_project, folder="/data/02_assembly", classname="file",
+                                 name="*.fasta", name_mode="glob", return_handler=True))
+        bi_assemblies = dict([(strip_end(f.name, ".fasta"), f) for f in bi_assemblies])
+        print("Found {} output assemblies".format(len(bi_assemblies)))
+
+        # the workflow inputs shared by every sample, kept in the run record
+        # so that a resumed launch uses the same ones
+        run_details = {"id": run_id, "workflow": args.workflow, "samples": {},
+                       "common_input": {
+                           "deplete.skip_depletion": args.skip_depletion is True,
+                           "scaffold.novocraft_tarball": dxpy.dxlink(args.novocraft),
+                           "scaffold.gatk_tarball": dxpy.dxlink(args.gatk)
+                       }}
+
+        # join them
+        sample_count = 0
+        for sample, bi_assembly in bi_assemblies.iteritems():
+            try:
+                bam = bi_input_bams[sample]
+            except:
+                raise KeyError("Couldn't find input BAM for " + sample)
+            run_details["samples"][sample] = {
+                "bi_assembly": bi_assembly.get_id(),
+                "input_bam": bam.get_id()
+            }
+            sample_count = sample_count+1
+            if args.limit and sample_count >= args.limit:
+                break
+
+        print("{} launching {} samples".format(run_id,sample_count))
+        project.new_folder(args.folder, parents=True)
+        run_record = dxpy.new_dxrecord(project=args.project, folder=args.folder, name=run_id,
+                                       details=run_details)
+        print("{} {}".format(run_id, run_record.get_id()))
+
+    failures = launch_samples(args, project, workflow, muscle_applet, run_record, run_details)
+    if failures:
+        for sample, error in failures:
+            print("\t".join(["launch_failed", sample, str(error)]))
+        exit("{} samples failed to launch; retry with --resume {}".format(len(failures), run_record.get_id()))
+
+    run_record.close()
+    print("{} {}".format(run_id, run_record.get_id()))
+
+def launch_samples(args, project, workflow, muscle_applet, run_record, run_details):
+    # Launch the workflow and MUSCLE job for each sample in the run that
+    # doesn't have them yet, several samples at a time. The run record is
+    # updated as launches complete (at most every few seconds), and any
+    # execution launched but not yet recorded when a previous attempt was
+    # interrupted is found by name and adopted, so nothing is launched
+    # twice. Returns (sample, exception) for each sample that failed.
+    run_id = run_details["id"]
+    common_input = run_details.get("common_input", {
+        "deplete.skip_depletion": args.skip_depletion is True,
+        "scaffold.novocraft_tarball": dxpy.dxlink(args.novocraft),
+        "scaffold.gatk_tarball": dxpy.dxlink(args.gatk)
+    })
+    pending = sorted((sample, sample_details) for sample, sample_details in run_details["samples"].iteritems()
+                     if "analysis" not in sample_details or "muscle" not in sample_details)
+    if not pending:
+        return []
+
+    launched = {}
+    if args.resume:
+        for result in dxpy.find_executions(project=project.get_id(), name=("viral-ngs-assembly validation " + run_id + " *"),
+                                           name_mode="glob", no_parent_analysis=True, include_subjobs=False,
+                                           describe={"fields": {"name": True}}):
+            launched[result["describe"]["name"]] = result["id"]
+
+    # lock guards run_details; flush_lock keeps set_details calls one at a
+    # time, in order. The details are copied under lock and saved outside
+    # it, so record() never waits on a throttled set_details, and an
+    # unforced flush is skipped while another is in progress.
+    lock = threading.Lock()
+    flush_lock = threading.Lock()
+    last_flush = [time.time()]
+    def flush(force=False):
+        if not flush_lock.acquire(force):
+            return
         try:
-            bam = bi_input_bams[sample]
-        except:
-            raise KeyError("Couldn't find input BAM for " + sample)
-        run_details["samples"][sample] = {
-            "bi_assembly": bi_assembly.get_id(),
-            "input_bam": bam.get_id()
-        }
-        sample_count = sample_count+1
-        if args.limit and sample_count >= args.limit:
-            break
+            with lock:
+                if not force and time.time() - last_flush[0] < 5:
+                    return
+                details = copy.deepcopy(run_details)
+                last_flush[0] = time.time()
+            retry_rate_limited(lambda: run_record.set_details(details))
+        finally:
+            flush_lock.release()
+    def record(sample_details, key, execution_id):
+        with lock:
+            sample_details[key] = execution_id
+        flush()
+
+    final_assembly = analysis_stage(workflow)["id"]+".final_assembly"
+
+    def find_launched(name, handler):
+        # the execution of this name a failed launch call may have created
+        # anyway, found the same way as on --resume
+        def find():
+            for result in dxpy.find_executions(project=project.get_id(), name=name, no_parent_analysis=True,
+                                               include_subjobs=False):
+                return handler(result["id"])
+            return None
+        return find
 
-    print("{} launching {} samples".format(run_id,sample_count))
-    project.new_folder(args.folder, parents=True)
-    run_record = dxpy.new_dxrecord(project=args.project, folder=args.folder, name=run_id)
-
-    # Launch workflow on each sample
-    for sample, sample_details in run_details["samples"].iteritems():
-        analysis_input = {
-            "deplete.file": dxpy.dxlink(sample_details["input_bam"]),
-            "deplete.skip_depletion": args.skip_depletion is True,
-            "scaffold.novocraft_tarball": dxpy.dxlink(args.novocraft),
-            "scaffold.gatk_tarball": dxpy.dxlink(args.gatk)
-        }
+    def launch_sample(sample, sample_details):
         analysis_folder = args.folder + "/" + sample
-        project.new_folder(analysis_folder, parents=True)
-        analysis = workflow.run(analysis_input, project=project.get_id(), folder=analysis_folder,
-                                name=("viral-ngs-assembly validation " + run_id + " "  + sample),
-                                priority="normal")
-        sample_details["analysis"] = analysis.get_id()
-        print("{} {}".format(analysis.get_id(),analysis.name))
+        analysis_name = "viral-ngs-assembly validation " + run_id + " "  + sample
+        if "analysis" not in sample_details:
+            if analysis_name in launched:
+                analysis = dxpy.DXAnalysis(launched[analysis_name])
+            else:
+                analysis_input = dict(common_input)
+                analysis_input["deplete.file"] = dxpy.dxlink(sample_details["input_bam"])
+                analysis = retry_rate_limited(lambda: workflow.run(analysis_input, project=project.get_id(),
+                                                                   folder=analysis_folder, name=analysis_name,
+                                                                   priority="normal"),
+                                              existing=find_launched(analysis_name, dxpy.DXAnalysis))
+            record(sample_details, "analysis", analysis.get_id())
+            print("{} {}".format(analysis.get_id(), analysis_name))
+        analysis = dxpy.DXAnalysis(sample_details["analysis"])
 
         # also schedule MUSCLE alignment of final assemblies
-        muscle_input = {
-            "fasta": [
-                dxpy.dxlink(sample_details["bi_assembly"]),
-                analysis.get_output_ref(workflow.get_stage("analysis")["id"]+".final_assembly")
-            ],
-            "output_format": "fasta",
-            "output_name": sample+"_validation_alignment",
-            "advanced_options": "-maxiters 2"
-        }
-        muscle_job = muscle_applet.run(muscle_input, project=project.get_id(), folder=analysis_folder,
-                                       name=("viral-ngs-assembly validation " + run_id + " "  + sample + " MUSCLE"),
-                                       instance_type="mem1_ssd1_x4", priority="normal")
-        sample_details["muscle"] = muscle_job.get_id()
-        print("{} {}".format(muscle_job.get_id(),muscle_job.name))
-
-    run_record.set_details(run_details)
-    run_record.close()
-    print("{} {}".format(run_id, run_record.get_id()))
+        if "muscle" not in sample_details:
+            muscle_name = analysis_name + " MUSCLE"
+            if muscle_name in launched:
+                muscle_job = dxpy.DXJob(launched[muscle_name])
+            else:
+                muscle_input = {
+                    "fasta": [
+                        dxpy.dxlink(sample_details["bi_assembly"]),
+                        analysis.get_output_ref(final_assembly)
+                    ],
+                    "output_format": "fasta",
+                    "output_name": sample+"_validation_alignment",
+                    "advanced_options": "-maxiters 2"
+                }
+                muscle_job = retry_rate_limited(lambda: muscle_applet.run(muscle_input, project=project.get_id(),
+                                                                          folder=analysis_folder, name=muscle_name,
+                                                                          instance_type="mem1_ssd1_x4",
+                                                                          priority="normal"),
+                                                existing=find_launched(muscle_name, dxpy.DXJob))
+            record(sample_details, "muscle", muscle_job.get_id())
+            print("{} {}".format(muscle_job.get_id(), muscle_name))
+
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # create the sample folders first (there's no batch call for this)
+        list(executor.map(lambda sample: retry_rate_limited(lambda: project.new_folder(args.folder + "/" + sample, parents=True)),
+                          [sample for sample, _ in pending]))
+        launches = dict((executor.submit(launch_sample, sample, sample_details), sample)
+                        for sample, sample_details in pending)
+        for future in concurrent.futures.as_completed(launches):
+            try:
+                future.result()
+            except Exception as e:
+                failures.append((launches[future], e))
+    flush(force=True)
+    return sorted(failures)
+
+def retry_rate_limited(call, attempts=8, delay=1.0, existing=None):
+    # retry an API call with jittered exponential backoff while the API
+    # server is throttling us (or briefly unavailable). A call that creates
+    # something may have done so before failing: existing, if given, is
+    # called before each retry to find that, and its result (unless None)
+    # is returned instead of calling again.
+    for attempt in xrange(attempts):
+        try:
+            if attempt > 0 and existing is not None:
+                found = existing()
+                if found is not None:
+                    return found
+            return call()
+        except dxpy.exceptions.DXAPIError as e:
+            if attempt == attempts-1 or not (e.code in (429, 503) or e.name == "RateLimitConditional"):
+                raise
+            time.sleep(delay * (2 ** attempt) * (1 + random.random()))
 
 parser_launch = subparsers.add_parser("launch")
 parser_launch.set_defaults(func=launch)
-parser_launch.add_argument("workflow", help="viral-ngs-assembly workflow ID (required)")
+parser_launch.add_argument("workflow", nargs="?", help="viral-ngs-assembly workflow ID (required unless resuming)")
 parser_launch.add_argument("--skip-depletion", action="store_true",
                            help="start from the cleaned BAMs")
 parser_launch.add_argument("--project", help="DNAnexus project ID (default: %(default)s)",
@@ -107,60 +245,199 @@ parser_launch.add_argument("--muscle", help="Muscle applet ID (default: %(defaul
                                        default="applet-BXQxjv00QyB9QF3vP4BpXg95")
 parser_launch.add_argument("--limit", metavar="N", type=int, default=None,
                                       help="Launch workflow on no more than this many samples")
+parser_launch.add_argument("--jobs", metavar="N", type=int, default=8,
+                                     help="Number of samples to launch at once (default: %(default)s)")
+parser_launch.add_argument("--resume", metavar="RECORD", default=None,
+                                       help="Finish an interrupted launch, given its run record ID")
 
 
 def postmortem(args):
     record = dxpy.DXRecord(dxpy.dxlink(args.record, args.project))
     run_details = record.get_details()
+    cache = PostmortemCache(args.cache or ":memory:")
 
-    finished = {}
-
-    # check for analysis completion
-    for sample, sample_details in run_details["samples"].iteritems():
-        analysis = dxpy.DXAnalysis(sample_details["analysis"])
-        analysis_desc = analysis.describe()
-        analysis_state = analysis_desc["state"]
-
-        if analysis_state == "in_progress":
-            print("\t".join(["analysis_in_progress", sample, analysis.get_id(), analysis_state]))
-        elif analysis_state != "done":
-            print("\t".join(["analysis_failed", sample, analysis.get_id(), analysis_state,
-                             str(get_analysis_output(analysis_desc, ".filtered_base_count")),
-                             str(get_analysis_output(analysis_desc, ".subsampled_base_count"))]))
+    rows = []
+    def emit(row):
+        if args.sorted:
+            rows.append(row)
         else:
-            muscle_job = dxpy.DXJob(sample_details["muscle"])
-            muscle_job_state = muscle_job.describe()["state"]
-            if muscle_job_state in ["idle", "waiting_on_input", "runnable", "running", "waiting_on_output"]:
-                print("\t".join(["muscle_in_progress", sample, muscle_job.get_id(), muscle_job_state]))
-            elif muscle_job_state != "done":
-                print("\t".join(["muscle_failed", sample, muscle_job.get_id(), muscle_job_state]))
-            else:
-                finished[sample] = (analysis,muscle_job)
+            print("\t".join(row))
+            sys.stdout.flush()
 
-    # compare the completed assemblies
-    for sample, (analysis, muscle_job) in finished.iteritems():
-        muscle_fasta = dxpy.DXFile(muscle_job.describe()["output"]["alignment"])
-        handle, local_fasta = tempfile.mkstemp(".fasta")
-        os.close(handle)
-        dxpy.download_dxfile(muscle_fasta.get_id(), local_fasta)
-        L, identical, N, gap, other = muscle_consensus_identity(local_fasta)
-        os.unlink(local_fasta)
+    # in --watch mode, each sample's final row is printed once, as soon as
+    # it's known, and the progress of the rest is summarized on stderr
+    while True:
+        in_progress = postmortem_pass(args, run_details, cache, emit, args.watch is None)
+        if args.watch is None or not in_progress:
+            break
+        sys.stderr.write("{} {} sample(s) in progress\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), len(in_progress)))
+        time.sleep(args.watch)
 
-        analysis_desc = analysis.describe()
-        print("\t".join(["validation_result", sample,
-                         str(get_analysis_output(analysis_desc, ".filtered_base_count")),
-                         str(get_analysis_output(analysis_desc, ".subsampled_base_count")),
-                         str(get_analysis_output(analysis_desc, ".mean_coverage_depth")),
-                         str(L), str(identical), "{:.2f}".format(100.0*identical/L),
-                         str(N), str(gap), str(other), str(analysis_desc["totalPrice"])]))
+    for row in sorted(rows, key=lambda row: (row[1], row[0])):
+        print("\t".join(row))
 
     # TODO: compare mapped BAMs?
 
+def postmortem_pass(args, run_details, cache, emit, emit_in_progress=True):
+    """
+    Report every sample in the run that cache hasn't seen finish yet (along
+    with, on the first pass, the cached results of the rest). Returns the
+    in-progress rows.
+    """
+    samples = sorted(run_details["samples"].iteritems())
+    in_progress = []
+    def emit_final(sample_details, row):
+        cache.put(sample_details, row)
+        emit(row)
+    def emit_progress(row):
+        in_progress.append(row)
+        if emit_in_progress:
+            emit(row)
+
+    # samples whose launch was interrupted or failed part way (see
+    # launch_samples) are reported once; `launch --resume` completes them
+    pending = []
+    for sample, sample_details in samples:
+        missing = [k for k in ("analysis", "muscle") if k not in sample_details]
+        if missing:
+            if not cache.reported(sample_details):
+                emit(["launch_incomplete", sample, sample_details.get("analysis", ""), "no " + " or ".join(missing)])
+                cache.mark_reported(sample_details)
+            continue
+        row = cache.get(sample_details)
+        if row is None:
+            pending.append((sample, sample_details))
+        elif not cache.reported(sample_details):
+            emit(row)
+            cache.mark_reported(sample_details)
+    if not pending:
+        return in_progress
+
+    # describe all the analyses and MUSCLE jobs up front
+    execution_descs = describe_executions(args.project, run_details["id"],
+                                          [sample_details[k] for _, sample_details in pending
+                                           for k in ("analysis", "muscle")],
+                                          args.jobs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # check for analysis completion, and queue up scoring of the finished ones
+        scoring = {}
+        for sample, sample_details in pending:
+            analysis_desc = execution_descs[sample_details["analysis"]]
+            analysis_state = analysis_desc["state"]
+
+            if analysis_state in ["failed", "terminated"]:
+                emit_final(sample_details,
+                           ["analysis_failed", sample, analysis_desc["id"], analysis_state,
+                            str(get_analysis_output(analysis_desc, ".filtered_base_count")),
+                            str(get_analysis_output(analysis_desc, ".subsampled_base_count"))])
+            elif analysis_state != "done":
+                emit_progress(["analysis_in_progress", sample, analysis_desc["id"], analysis_state])
+            else:
+                muscle_desc = execution_descs[sample_details["muscle"]]
+                muscle_job_state = muscle_desc["state"]
+                if muscle_job_state in ["failed", "terminated"]:
+                    emit_final(sample_details, ["muscle_failed", sample, muscle_desc["id"], muscle_job_state])
+                elif muscle_job_state != "done":
+                    emit_progress(["muscle_in_progress", sample, muscle_desc["id"], muscle_job_state])
+                else:
+                    scoring[executor.submit(score_alignment, muscle_desc)] = (sample, sample_details, analysis_desc)
+
+        # compare the completed assemblies, reporting each as soon as it's scored
+        for future in concurrent.futures.as_completed(scoring):
+            sample, sample_details, analysis_desc = scoring[future]
+            L, identical, N, gap, other = future.result()
+            emit_final(sample_details,
+                       ["validation_result", sample,
+                        str(get_analysis_output(analysis_desc, ".filtered_base_count")),
+                        str(get_analysis_output(analysis_desc, ".subsampled_base_count")),
+                        str(get_analysis_output(analysis_desc, ".mean_coverage_depth")),
+                        str(L), str(identical), "{:.2f}".format(100.0*identical/L),
+                        str(N), str(gap), str(other), str(analysis_desc["totalPrice"])])
+
+    return in_progress
+
+class PostmortemCache(object):
+    """
+    Final postmortem rows (failures and validation results) of samples whose
+    analysis and MUSCLE job have reached a terminal state, keyed by their
+    IDs, so that later postmortems of the same run only need to look at the
+    samples that are new or still in progress. Rows fetched from or stored
+    in the cache are marked as reported for the lifetime of this object.
+    Samples are keyed on whichever of the IDs they have, so partially
+    launched ones can be marked as reported too.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS postmortem (
+                               analysis TEXT NOT NULL,
+                               muscle TEXT NOT NULL,
+                               row TEXT NOT NULL,
+                               PRIMARY KEY (analysis, muscle))""")
+        self.db.commit()
+        self._reported = set()
+
+    @staticmethod
+    def key(sample_details):
+        return (sample_details.get("analysis", ""), sample_details.get("muscle", ""))
+
+    def get(self, sample_details):
+        result = self.db.execute("SELECT row FROM postmortem WHERE analysis = ? AND muscle = ?",
+                                 self.key(sample_details)).fetchone()
+        return [str(x) for x in json.loads(result[0])] if result else None
+
+    def put(self, sample_details, row):
+        self.db.execute("INSERT OR REPLACE INTO postmortem (analysis, muscle, row) VALUES (?, ?, ?)",
+                        self.key(sample_details) + (json.dumps(row),))
+        self.db.commit()
+        self.mark_reported(sample_details)
+
+    def reported(self, sample_details):
+        return self.key(sample_details) in self._reported
+
+    def mark_reported(self, sample_details):
+        self._reported.add(self.key(sample_details))
+
 parser_postmortem = subparsers.add_parser("postmortem")
 parser_postmortem.set_defaults(func=postmortem)
 parser_postmortem.add_argument("record", help="ID of the run record created at launch (required)")
 parser_postmortem.add_argument("--project", help="DNAnexus project ID (default: %(default)s)",
                                             default="project-BX6FjJ00QyB3X12J59PVYZ1V")
+parser_postmortem.add_argument("--jobs", metavar="N", type=int, default=8,
+                                         help="Number of samples to download and score at once (default: %(default)s)")
+parser_postmortem.add_argument("--sorted", action="store_true",
+                                           help="Print all rows at the end, ordered by sample, instead of as they complete")
+parser_postmortem.add_argument("--cache", metavar="PATH", default=None,
+                                          help="SQLite file recording finished samples, which later postmortems of the run won't describe or download again")
+parser_postmortem.add_argument("--watch", metavar="SECONDS", type=int, nargs="?", const=300, default=None,
+                                          help="Poll until every sample is finished, waiting this long between polls (default: %(const)s)")
+
+def describe_executions(project, run_id, execution_ids, max_workers):
+    # Describe the run's analyses and MUSCLE jobs by ID. One find_executions
+    # query on the names given at launch returns nearly all of them; any
+    # it misses (e.g. renamed since) are described individually.
+    wanted = set(execution_ids)
+    descs = {}
+    for result in dxpy.find_executions(project=project, name=("viral-ngs-assembly validation " + run_id + " *"),
+                                       name_mode="glob", no_parent_analysis=True, include_subjobs=False,
+                                       describe=True):
+        if result["id"] in wanted:
+            descs[result["id"]] = result["describe"]
+    missing = sorted(wanted - set(descs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for desc in executor.map(dxpy.describe, missing):
+            descs[desc["id"]] = desc
+    return descs
+
+def score_alignment(muscle_desc):
+    muscle_fasta = dxpy.DXFile(muscle_desc["output"]["alignment"])
+    handle, local_fasta = tempfile.mkstemp(".fasta")
+    os.close(handle)
+    try:
+        dxpy.download_dxfile(muscle_fasta.get_id(), local_fasta)
+        return muscle_consensus_identity(local_fasta)
+    finally:
+        os.unlink(local_fasta)
 
 def generate_run_id(workflow):
     # detect git revision
@@ -169,6 +446,12 @@ def generate_run_id(workflow):
     git_revision = workflow_props["git_revision"] if "git_revision" in workflow_props else "unknown"
     return time.strftime("%Y-%m-%d-%H%M%S-") + git_revision
 
+def analysis_stage(workflow):
+    # the stage running the assembly analysis: 'analysis', or 'refine' in a
+    # workflow built with build_workflows.py --fused-refinement
+    stages = dict((stage["name"], stage) for stage in workflow.describe()["stages"])
+    return stages["analysis"] if "analysis" in stages else stages["refine"]
+
 def get_analysis_output(desc, output_name):
     if "output" in desc:
         for k, v in desc["output"].iteritems():
@@ -176,13 +459,63 @@ def get_analysis_output(desc, output_name):
                 return v
     return None
 
-def muscle_consensus_identity(fasta):
+def read_alignment(fasta):
     seqs = []
     with open(fasta, "rU") as infile:
         for record in SeqIO.parse(infile, "fasta") :
-            seqs.append(record.seq.upper())
+            seqs.append(str(record.seq.upper()))
+    return seqs
+
+def muscle_consensus_identity(fasta):
+    seqs = read_alignment(fasta)
     assert (len(seqs) == 2)
-    assert (len(seqs[0]) == len(seqs[1]))
+    return alignment_identity(seqs)[0]
+
+def alignment_identity(seqs):
+    """
+    Compare each aligned sequence against the first (reference) row. Returns
+    one (L, identical, N, gap, other) tuple per non-reference row, where a
+    mismatched column counts as N if either base is N, else as gap if either
+    is a gap, else as other.
+    """
+    assert (len(seqs) >= 2)
+    L = len(seqs[0])
+    assert all(len(seq) == L for seq in seqs)
+    ref, rows = alignment_masks(seqs)
+    identical = rows == ref
+    N = ~identical & ((rows == ord("N")) | (ref == ord("N")))
+    gap = ~identical & ~N & ((rows == ord("-")) | (ref == ord("-")))
+    results = []
+    for i in xrange(len(rows)):
+        n_identical = int(numpy.count_nonzero(identical[i]))
+        n_N = int(numpy.count_nonzero(N[i]))
+        n_gap = int(numpy.count_nonzero(gap[i]))
+        results.append((L, n_identical, n_N, n_gap, L - n_identical - n_N - n_gap))
+    return results
+
+def alignment_masks(seqs):
+    # the aligned sequences as a (rows x L) byte array, split into the
+    # reference row and the rest
+    L = len(seqs[0])
+    aln = numpy.frombuffer("".join(seqs), dtype=numpy.uint8).reshape(len(seqs), L)
+    return aln[0], aln[1:]
+
+def identity_profile(seqs, window):
+    """
+    Fraction of identical columns within consecutive windows of the
+    alignment, for each non-reference row against the first. Returns the
+    window start offsets and a (rows-1 x windows) array; the last window may
+    be shorter.
+    """
+    ref, rows = alignment_masks(seqs)
+    starts = numpy.arange(0, len(ref), window)
+    widths = numpy.diff(numpy.append(starts, len(ref)))
+    identical = numpy.add.reduceat((rows == ref).astype(numpy.int64), starts, axis=1)
+    return starts, identical / widths.astype(float)
+
+def muscle_consensus_identity_loop(seqs):
+    # original per-column implementation, kept as the reference for the
+    # identity --benchmark check
     L = len(seqs[0])
     identical = 0
     N = 0
@@ -199,6 +532,53 @@ def muscle_consensus_identity(fasta):
             other = other + 1
     return (L,identical,N,gap,other)
 
+def identity(args):
+    if args.benchmark:
+        # synthetic Ebola-length alignment with a sprinkling of N's, gaps and SNPs
+        rng = random.Random(0)
+        ref = [rng.choice("ACGT") for i in xrange(args.benchmark_length)]
+        alt = list(ref)
+        for i in rng.sample(xrange(len(alt)), len(alt)//50):
+            alt[i] = rng.choice("ACGTN-")
+        seqs = ["".join(ref), "".join(alt)]
+        t0 = time.time()
+        for i in xrange(args.benchmark_rounds):
+            expected = muscle_consensus_identity_loop(seqs)
+        t1 = time.time()
+        for i in xrange(args.benchmark_rounds):
+            result = alignment_identity(seqs)[0]
+        t2 = time.time()
+        assert result == expected, (result, expected)
+        print("\t".join(["benchmark", str(args.benchmark_length), str(args.benchmark_rounds),
+                         "{:.6f}".format((t1-t0)/args.benchmark_rounds),
+                         "{:.6f}".format((t2-t1)/args.benchmark_rounds),
+                         "{:.1f}x".format((t1-t0)/max(t2-t1, 1e-9))]))
+
+    for fasta in args.fasta:
+        seqs = read_alignment(fasta)
+        for row, (L, identical, N, gap, other) in enumerate(alignment_identity(seqs), 1):
+            print("\t".join(["identity", fasta, str(row), str(L), str(identical),
+                             "{:.2f}".format(100.0*identical/L), str(N), str(gap), str(other)]))
+        if args.window:
+            starts, profile = identity_profile(seqs, args.window)
+            for row in xrange(len(profile)):
+                for start, fraction in zip(starts, profile[row]):
+                    print("\t".join(["window", fasta, str(row+1), str(start),
+                                     str(min(start+args.window, len(seqs[0]))), "{:.2f}".format(100.0*fraction)]))
+
+parser_identity = subparsers.add_parser("identity")
+parser_identity.set_defaults(func=identity)
+parser_identity.add_argument("fasta", nargs="*",
+                             help="Local MUSCLE alignment FASTA; rows after the first are compared against it")
+parser_identity.add_argument("--window", metavar="N", type=int, default=None,
+                             help="Also report percent identity within windows of this many alignment columns")
+parser_identity.add_argument("--benchmark", action="store_true",
+                             help="Time the vectorized comparison against the per-column loop on a synthetic alignment")
+parser_identity.add_argument("--benchmark-length", metavar="N", type=int, default=18959,
+                             help="Synthetic alignment length (default: %(default)s, the Ebola genome)")
+parser_identity.add_argument("--benchmark-rounds", metavar="N", type=int, default=10,
+                             help="Timing repetitions (default: %(default)s)")
+
 def strip_end(text, suffix):
     if not text.endswith(suffix):
         return text